@@ -1,18 +1,51 @@
 import streamlit as st
 import streamlit.components.v1 as components
+try: from streamlit.runtime.scriptrunner import get_script_run_ctx
+except ImportError: get_script_run_ctx = lambda: None  # API interna: senza, il profiler misura solo i tempi
 from pyairtable import Api
 import pandas as pd
+import numpy as np
 import altair as alt
 from datetime import date, datetime, timedelta
 import io
 import os
 import base64
+import logging
 import time 
+from datastore import BATCH_AIRTABLE, TableStore, cartella_snapshot
+import rollup
+import logica
+from prenotazioni import CalendarioPrestiti
+from profiler import RegistroProfili, PROFILI_DIR
+from collegamenti import CAMPO_LINK, TABELLE_COLLEGATE, IndicePazienti, nome_paziente, piano_migrazione, migra
+from movimenti import MOTIVO_RETTIFICA, TABELLA as TABELLA_MOVIMENTI, Consumi, CodaMovimenti, evento_da_record, percorso_db
+from sedi import StoreSedi, COLONNA_SEDE
+import archivio
 
 # =========================================================
 # 0. CONFIGURAZIONE & STILE
 # =========================================================
 st.set_page_config(page_title="Gestionale Fisio Pro", page_icon="🏥", layout="wide")
+log = logging.getLogger("fisio")
+
+# --- PROFILAZIONE (opzionale: ?profile=1, FISIO_PROFILING=1 o PROFILING nei secrets) ---
+PROFILAZIONE = st.query_params.get("profile") == "1" or os.environ.get("FISIO_PROFILING") == "1" or ("PROFILING" in st.secrets and bool(st.secrets["PROFILING"]))
+
+@st.cache_resource(show_spinner=False)
+def registro_profili():
+    return RegistroProfili()
+
+profilo = None
+if PROFILAZIONE:
+    # Un profilo rimasto aperto = rerun precedente interrotto da st.rerun()/st.stop()
+    precedente = st.session_state.pop("_profilo_aperto", None)
+    if precedente is not None and precedente.durata is None:
+        precedente.chiudi(interrotto=True); registro_profili().registra(precedente)
+    profilo = registro_profili().avvia(get_script_run_ctx())
+    st.session_state._profilo_aperto = profilo
+
+def segna(nome):
+    if profilo is not None: profilo.segna(nome)
 
 st.markdown("""
 <style>
@@ -41,12 +74,18 @@ st.markdown("""
 # --- 1. CONNESSIONE ---
 API_KEY = None
 BASE_ID = None
+BASI = {}
 
 if "AIRTABLE_TOKEN" in st.secrets:
     API_KEY = st.secrets["AIRTABLE_TOKEN"]
-    BASE_ID = st.secrets["AIRTABLE_BASE_ID"]
+    BASE_ID = st.secrets.get("AIRTABLE_BASE_ID")
+
+# Più sedi: sezione [AIRTABLE_BASES] nei secrets, una base per sede
+# (es. Milano = "app...", Monza = "app..."). Senza, una sola base.
+if "AIRTABLE_BASES" in st.secrets: BASI = dict(st.secrets["AIRTABLE_BASES"])
+elif BASE_ID: BASI = {"Principale": BASE_ID}
 
-if not API_KEY or not BASE_ID:
+if not API_KEY or not BASI:
     with st.sidebar:
         with st.expander("⚙️ Configurazione API", expanded=True):
             st.warning("⚠️ Chiavi non trovate. Inseriscile qui:")
@@ -55,8 +94,55 @@ if not API_KEY or not BASE_ID:
             if not API_KEY or not BASE_ID:
                 st.info("Inserisci le chiavi per avviare.")
                 st.stop()
+            BASI = {"Principale": BASE_ID}
+
+# Ogni quanti secondi il refresher in background riscarica ciascuna tabella.
+# Sovrascrivibile da secrets con una sezione [REFRESH_SCHEDULE].
+REFRESH_SCHEDULE = {
+    "Prestiti": 30, "Consegne": 30, "Pazienti": 60,
+    "Preventivi_Salvati": 120, "Inventario": 120,
+    "Preventivi_Standard": 900, "Servizi": 1800, "Scadenze": 300,
+}
+if "REFRESH_SCHEDULE" in st.secrets:
+    REFRESH_SCHEDULE.update({k: int(v) for k, v in st.secrets["REFRESH_SCHEDULE"].items()})
+
+# Store unico per processo e per base: tutte le sessioni (reception, terapisti,
+# ufficio) leggono gli stessi snapshot e ogni scrittura lo aggiorna per tutti.
+@st.cache_resource(show_spinner=False)
+def get_store(api_key, base_id):
+    s = TableStore(Api(api_key), base_id)
+    s.carica_snapshot(cartella_snapshot(base_id))  # snapshot lasciati dal job notturno (cli.py sync)
+    s.start_refresher(REFRESH_SCHEDULE)
+    return s
+
+# Vista su una o più sedi: legge in parallelo dai TableStore delle basi scelte
+@st.cache_resource(show_spinner=False)
+def get_sedi(api_key, basi, predefinita):
+    return StoreSedi({sede: get_store(api_key, base_id) for sede, base_id in basi}, predefinita)
+
+TUTTE_LE_SEDI = "🏥 Tutte le sedi"
+sedi_tutte = get_sedi(API_KEY, tuple(BASI.items()), None)
+
+# Registro Movimenti: una coda per base, scritta in background a blocchi di 10.
+# Al primo avvio i consumi si ricostruiscono dallo storico della base.
+@st.cache_resource(show_spinner=False)
+def get_movimenti(api_key, base_id):
+    base = get_store(api_key, base_id)
+    consumi = Consumi(percorso_db(base_id))
+    if consumi.vuoto():
+        # Lettura diretta (solo rate limit, fuori dallo store): se la tabella
+        # non esiste ancora l'errore non conta nel circuit breaker della base
+        try: consumi.applica([evento_da_record(r['id'], r['fields']) for r in base.table(TABELLA_MOVIMENTI).all()])
+        except Exception: log.warning("Registro %s della base %s non letto: consumi da zero", TABELLA_MOVIMENTI, base_id, exc_info=True)
+    return CodaMovimenti(base, consumi)
 
-api = Api(API_KEY)
+def coda_movimenti(rid):
+    return get_movimenti(API_KEY, store.store_di(rid).base_id)
+
+def tassi_consumi():
+    tassi = {}
+    for s in store.stores.values(): tassi.update(get_movimenti(API_KEY, s.base_id).consumi.tassi())
+    return tassi
 
 # --- 2. FUNZIONI ---
 def safe_str(val):
@@ -64,35 +150,36 @@ def safe_str(val):
     if pd.isna(val): return ""
     return str(val).strip()
 
-# RIMOSSO @st.cache_data per forzare il refresh e gestire meglio gli errori
-def get_data(table_name):
+# Le letture passano dallo store condiviso: la tabella viene scaricata una volta
+# sola per processo (rate limit incluso) e non una volta per sessione.
+# Se Airtable non risponde si continua a servire l'ultimo snapshot buono;
+# solo se la tabella non è mai stata scaricata la pagina si ferma, invece di
+# mostrare un falso "nessun dato".
+TABELLE_LETTE = set()
+
+def get_data(table_name, solo_carica=False):
+    # solo_carica=True: nessuna copia del DataFrame, per chi legge poi con store.records()/record()
+    TABELLE_LETTE.add(table_name)
     try:
-        # --- FIX DEFINITIVO 429: RALLENTAMENTO DI 1 SECONDO ---
-        time.sleep(1.0) 
-        # -----------------------------------------------------
-        table = api.table(BASE_ID, table_name)
-        records = table.all()
-        if not records: return pd.DataFrame()
-        data = [{'id': r['id'], **r['fields']} for r in records]
-        return pd.DataFrame(data)
+        if solo_carica: return store.assicura(table_name)
+        return store.get(table_name)
     except Exception as e:
-        # Gestisce l'errore senza mostrare il box rosso gigante
-        if "429" in str(e):
-            st.warning(f"⏳ Traffico alto. Sto riprovando a caricare '{table_name}'...")
-            time.sleep(2) # Aspetta altri 2 secondi e riprova
-            try:
-                table = api.table(BASE_ID, table_name)
-                records = table.all()
-                data = [{'id': r['id'], **r['fields']} for r in records]
-                return pd.DataFrame(data)
-            except:
-                return pd.DataFrame() # Rinuncia silenziosamente se fallisce 2 volte
-        else:
-            st.error(f"Errore {table_name}: {e}")
-            return pd.DataFrame()
+        st.error(f"⚠️ '{table_name}' non disponibile al momento: riprovo in background, ricarica tra poco. ({e})")
+        st.stop()
+
+def mostra_badge_dati(slot):
+    # "Dati delle HH:MM" per le tabelle usate in questa pagina
+    stati = [store.stato(t) for t in TABELLE_LETTE]
+    stati = [(ts, vecchio) for ts, vecchio in stati if ts is not None]
+    if not stati: return
+    ts = min(t for t, _ in stati)
+    ora = datetime.fromtimestamp(ts).strftime('%H:%M')
+    if any(v for _, v in stati): slot.warning(f"🕒 Dati delle {ora}: Airtable non risponde, riprovo in background.")
+    else: slot.caption(f"🟢 Dati delle {ora}")
 
 def save_paziente(n, c, a, d):
-    try: api.table(BASE_ID, "Pazienti").create({"Nome": n, "Cognome": c, "Area": a, "Disdetto": d}, typecast=True); return True
+    s = store.store_di()
+    try: s.upsert("Pazienti", s.table("Pazienti").create({"Nome": n, "Cognome": c, "Area": a, "Disdetto": d}, typecast=True)); return True
     except: return False
 
 def update_generic(tbl, rid, data):
@@ -102,56 +189,216 @@ def update_generic(tbl, rid, data):
             if v is None: clean_data[k] = None
             elif hasattr(v, 'strftime'): clean_data[k] = v.strftime('%Y-%m-%d')
             else: clean_data[k] = v
-        api.table(BASE_ID, tbl).update(rid, clean_data, typecast=True)
-        time.sleep(1.0) # Pausa dopo aggiornamento
+        s = store.store_di(rid)
+        s.upsert(tbl, s.table(tbl).update(rid, clean_data, typecast=True))
         return True
     except: return False
 
 def delete_generic(tbl, rid):
-    try: api.table(BASE_ID, tbl).delete(rid); return True
+    s = store.store_di(rid)
+    try: s.table(tbl).delete(rid); s.remove(tbl, rid); return True
     except: return False
 
-def save_preventivo_temp(paziente, dettagli_str, totale, note):
-    try: api.table(BASE_ID, "Preventivi_Salvati").create({"Paziente": paziente, "Dettagli": dettagli_str, "Totale": totale, "Note": note, "Data_Creazione": str(date.today())}, typecast=True); return True
-    except: return False
+# Il nome resta salvato come testo (stampe, viste Airtable); il collegamento
+# vero al paziente è il campo link con il record id.
+def link_paziente(paziente_id):
+    return {CAMPO_LINK: [paziente_id]} if paziente_id else {}
+
+# (base, tabella) dove Airtable ha rifiutato il campo link perché non esiste
+# ancora: lì si salva solo il nome, senza ritentare a ogni record.
+@st.cache_resource(show_spinner=False)
+def tabelle_senza_link():
+    return set()
+
+def crea_collegato(tbl, campi, paziente_id):
+    # Crea il record nella base del paziente (i link non attraversano le basi)
+    s = store.store_di(paziente_id)
+    chiave = (s.base_id, tbl)
+    link = {} if chiave in tabelle_senza_link() else link_paziente(paziente_id)
+    try: rec = s.table(tbl).create({**campi, **link}, typecast=True)
+    except Exception as e:
+        if not link or "UNKNOWN_FIELD_NAME" not in str(e): raise
+        tabelle_senza_link().add(chiave)
+        st.toast(f"Il campo {CAMPO_LINK} non esiste in {tbl}: record salvato solo con il nome del paziente. Aggiungilo in Airtable per collegarlo.", icon="⚠️")
+        rec = s.table(tbl).create(campi, typecast=True)
+    s.upsert(tbl, rec)
+
+# Aggiornamenti multipli in blocchi da 10 record (limite batch di Airtable):
+# una richiesta ogni 10 righe invece di una per riga, separati per sede.
+# Ritorna il numero di record salvati.
+CAMPI_INVENTARIO = {'Quantita': "Quantità", 'Obiettivo': "Obiettivo", 'Soglia_Minima': "Soglia_Minima"}
+
+def update_batch(tbl, aggiornamenti):
+    per_store = {}
+    for agg in aggiornamenti: per_store.setdefault(store.store_di(agg['id']), []).append(agg)
+    salvati = 0
+    for s, lista in per_store.items():
+        for i in range(0, len(lista), BATCH_AIRTABLE):
+            try:
+                for rec in s.table(tbl).batch_update(lista[i:i + BATCH_AIRTABLE], typecast=True):
+                    s.upsert(tbl, rec); salvati += 1
+            except Exception as e: st.error(f"Errore {tbl}: {e}")
+    return salvati
+
+# Ogni cambio di Quantità finisce anche nel registro Movimenti (append-only)
+def registra_movimento(rid, prima, dopo, motivo):
+    rec = store.record("Inventario", rid) or {}
+    coda_movimenti(rid).aggiungi(rid, rec.get('Materiali'), rec.get('Area'), int(dopo) - int(prima), dopo, motivo)
+
+def aggiorna_quantita(rid, nuova, motivo):
+    prima = int((store.record("Inventario", rid) or {}).get('Quantità') or 0)
+    if not update_generic("Inventario", rid, {"Quantità": int(nuova)}): return False
+    registra_movimento(rid, prima, nuova, motivo)
+    return True
+
+def save_preventivo_temp(paziente, dettagli_str, totale, note, paziente_id=None):
+    try: crea_collegato("Preventivi_Salvati", {"Paziente": paziente, "Dettagli": dettagli_str, "Totale": totale, "Note": note, "Data_Creazione": str(date.today())}, paziente_id); return True
+    except Exception as e: st.error(f"Errore Salvataggio: {e}"); return False
 
 def save_materiale_avanzato(materiale, area, quantita, obiettivo, soglia):
     try: 
-        api.table(BASE_ID, "Inventario").create({
+        s = store.store_di()
+        rec = s.table("Inventario").create({
             "Materiali": materiale, 
             "Area": area,
             "Quantità": int(quantita),
             "Obiettivo": int(obiettivo),
             "Soglia_Minima": int(soglia)
         }, typecast=True)
+        s.upsert("Inventario", rec)
+        registra_movimento(rec['id'], 0, quantita, "Carico")
         return True
     except Exception as e: st.error(f"Errore Salvataggio: {e}"); return False
 
-def save_consegna(paziente, area, indicazione, scadenza):
+def save_consegna(paziente, area, indicazione, scadenza, paziente_id=None):
     try:
-        api.table(BASE_ID, "Consegne").create({
+        crea_collegato("Consegne", {
             "Paziente": paziente, "Area": area, "Indicazione": indicazione, 
             "Data_Scadenza": str(scadenza), "Completato": False
-        }, typecast=True)
+        }, paziente_id)
         return True
-    except: return False
+    except Exception as e: st.error(f"Errore Salvataggio: {e}"); return False
 
-def save_prestito_new(paziente, oggetto, categoria, data_prestito, data_scadenza):
+def save_prestito_new(paziente, oggetto, categoria, data_prestito, data_scadenza, paziente_id=None):
     try: 
-        api.table(BASE_ID, "Prestiti").create({
+        crea_collegato("Prestiti", {
             "Paziente": paziente, 
             "Oggetto": oggetto,
             "Categoria": categoria, 
             "Data_Prestito": str(data_prestito), 
             "Data_Scadenza": str(data_scadenza),
             "Restituito": False
-        }, typecast=True)
-        time.sleep(1.0)
+        }, paziente_id)
         return True
     except Exception as e:
         st.error(f"Errore: {e}")
         return False
 
+# --- SCADENZE RICORRENTI ---
+# Su Airtable si salva solo la REGOLA (es. "Affitto, mensile dal 05/01/2024"):
+# le singole date vengono generate al volo per l'orizzonte richiesto.
+FREQUENZE = ["Una Tantum", "Settimanale", "Mensile", "Trimestrale", "Semestrale", "Annuale"]
+MESI_FREQUENZA = {"Mensile": 1, "Trimestrale": 3, "Semestrale": 6, "Annuale": 12}
+
+def save_scadenza(descrizione, importo, categoria, frequenza, inizio, fine):
+    try:
+        s = store.store_di()
+        s.upsert("Scadenze", s.table("Scadenze").create({
+            "Descrizione": descrizione, "Importo": float(importo), "Categoria": categoria,
+            "Frequenza": frequenza, "Data_Inizio": str(inizio),
+            "Data_Fine": str(fine) if fine else None
+        }, typecast=True))
+        return True
+    except Exception as e: st.error(f"Errore Salvataggio: {e}"); return False
+
+def espandi_scadenze(df_regole, da, a):
+    # Tutte le regole insieme: per ognuna si calcola quante occorrenze cadono
+    # in [da, a], poi np.repeat + un contatore per riga danno tutte le date in
+    # un colpo (nessun DataFrame per regola). Mensili/trimestrali/...: stesso
+    # giorno del mese di partenza, il 31 diventa l'ultimo giorno dei mesi corti.
+    cols = ['id', 'Descrizione', 'Categoria', 'Importo', 'Data', 'Pagato']
+    r = df_regole[df_regole['Data_Inizio'].notna()].reset_index(drop=True) if not df_regole.empty else df_regole
+    if r.empty: return pd.DataFrame(columns=cols)
+    da, a = pd.Timestamp(da).normalize(), pd.Timestamp(a).normalize()
+    ini = r['Data_Inizio'].dt.normalize()
+    fine = r['Data_Fine'].dt.normalize().fillna(a).clip(upper=a)
+    ini_d = ini.to_numpy().astype('datetime64[D]')
+    fine_d = fine.to_numpy().astype('datetime64[D]')
+    ini_m = (ini.dt.year * 12 + ini.dt.month - 1).to_numpy()
+    fine_m = (fine.dt.year * 12 + fine.dt.month - 1).to_numpy()
+
+    passo = r['Frequenza'].map(MESI_FREQUENZA).fillna(0).astype(int).to_numpy()
+    mensile = passo > 0
+    settimanale = (r['Frequenza'] == "Settimanale").to_numpy()
+    # Primo e ultimo indice di occorrenza dentro l'orizzonte
+    p_m = np.where(mensile, passo, 1)
+    k0 = np.select([mensile, settimanale], [-((ini_m - (da.year * 12 + da.month - 1)) // p_m), -((ini_d - np.datetime64(da.date(), 'D')).astype(np.int64) // 7)], 0).clip(min=0)
+    k1 = np.select([mensile, settimanale], [(fine_m - ini_m) // p_m, (fine_d - ini_d).astype(np.int64) // 7], np.where(ini_d <= fine_d, 0, -1))
+    n = (k1 - k0 + 1).clip(min=0)
+    if n.sum() == 0: return pd.DataFrame(columns=cols)
+
+    idx = np.repeat(np.arange(len(r)), n)
+    k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n) + np.repeat(k0, n)
+    mese = (ini_m[idx] + k * p_m[idx] - 1970 * 12).astype('datetime64[M]')
+    giorni_mese = (mese + 1).astype('datetime64[D]') - mese.astype('datetime64[D]')
+    giorno = np.minimum(ini.dt.day.to_numpy()[idx], giorni_mese.astype(np.int64))
+    data = np.where(mensile[idx], mese.astype('datetime64[D]') + (giorno - 1),
+                    np.where(settimanale[idx], ini_d[idx] + 7 * k, ini_d[idx]))
+    dentro = (data >= np.datetime64(da.date(), 'D')) & (data <= fine_d[idx])
+    idx, data = idx[dentro], data[dentro].astype('datetime64[ns]')
+
+    pagato_fino = r['Pagato_Fino'].to_numpy().astype('datetime64[ns]')[idx]
+    occ = pd.DataFrame({c: r[c].to_numpy()[idx] for c in ['id', 'Descrizione', 'Categoria', 'Importo']})
+    occ['Data'] = data
+    occ['Pagato'] = ~np.isnat(pagato_fino) & (data <= pagato_fino)
+    return occ.sort_values('Data', kind='stable', ignore_index=True)
+
+def flusso_cassa(df_occ, freq="MS"):
+    # Totali per mese ("MS") o settimana ("W-MON") con un solo resample
+    if df_occ.empty: return pd.Series(dtype=float)
+    return df_occ.set_index('Data')['Importo'].resample(freq).sum()
+
+# --- ROLLUP GIORNALIERI ---
+# Condiviso tra le sessioni: il giorno corrente viene riscritto al massimo ogni
+# 15 minuti (vedi rollup.py). Gli errori non finiscono in cache: si riprova al
+# rerun successivo e intanto la Dashboard avvisa che lo storico è fermo.
+@st.cache_data(ttl=900, show_spinner=False)
+def aggiorna_rollup(giorno):
+    # Sempre su tutte le sedi: lo storico del gruppo non dipende dalla vista scelta
+    return rollup.aggiorna(sedi_tutte.get("Pazienti"), sedi_tutte.get("Prestiti"), sedi_tutte.get("Preventivi_Salvati"))
+
+# --- CALENDARIO PRESTITI ---
+# Indice degli intervalli per strumento, ricostruito solo quando cambia la
+# versione della tabella Prestiti (o il giorno) e condiviso tra le sessioni.
+@st.cache_resource(max_entries=4, show_spinner=False)
+def calendario_prestiti(versione, giorno):
+    return CalendarioPrestiti(store.records("Prestiti"))
+
+# --- PAZIENTI: SELEZIONE E INDICI ---
+def nomi_pazienti():
+    # {id: "Cognome Nome"} ordinato per nome (Pazienti deve essere già caricato)
+    return dict(sorted(((pid, nome_paziente(f)) for pid, f in store.records("Pazienti").items()), key=lambda x: x[1].casefold()))
+
+def scegli_paziente(container, label, nomi, **kwargs):
+    # Selectbox che restituisce il record id (None = nessuna scelta)
+    return container.selectbox(label, [None] + list(nomi), format_func=lambda pid: "-- Seleziona --" if pid is None else nomi.get(pid, "?"), **kwargs)
+
+# Indici per paziente ricostruiti solo quando cambia la versione di una delle
+# tabelle coinvolte (cioè a ogni sincronizzazione o scrittura).
+@st.cache_resource(max_entries=2, show_spinner=False)
+def indice_pazienti(versioni):
+    return IndicePazienti(store.records("Pazienti"), {t: store.records(t) for t in TABELLE_COLLEGATE})
+
+# Piano di migrazione per tabella: {tabella: (da collegare, irrisolti)}, base
+# per base perché un link può puntare solo a pazienti della stessa base
+@st.cache_resource(max_entries=2, show_spinner=False)
+def piano_collegamenti(versioni):
+    piani = {}
+    for t in TABELLE_COLLEGATE:
+        parti = [piano_migrazione(s.records(t), s.records("Pazienti")) for s in store.stores.values()]
+        piani[t] = (sum(len(agg) for agg, _ in parti), [x for _, irr in parti for x in irr])
+    return piani
+
 def get_base64_image(image_path):
     try:
         with open(image_path, "rb") as img_file: return base64.b64encode(img_file.read()).decode()
@@ -206,6 +453,7 @@ def generate_html_preventivo(paziente, data_oggi, note, righe_preventivo, totale
     """
 
 # --- 3. INTERFACCIA ---
+segna("setup")
 with st.sidebar:
     LOGO_B64 = ""
     try: 
@@ -214,8 +462,21 @@ with st.sidebar:
     except: 
         st.title("Focus Rehab")
         
-    menu = st.radio("Menu", ["⚡ Dashboard", "👥 Pazienti", "💳 Preventivi", "📨 Consegne", "📦 Magazzino", "🔄 Prestiti", "📅 Scadenze"], label_visibility="collapsed")
+    menu = st.radio("Menu", ["⚡ Dashboard", "👥 Pazienti", "💳 Preventivi", "📨 Consegne", "📦 Magazzino", "🔄 Prestiti", "📅 Scadenze", "🗄️ Archivio"], label_visibility="collapsed")
+
+    # Vista per sede o di gruppo; i record nuovi senza paziente vanno nella sede scelta
+    store = sedi_tutte
+    if len(BASI) > 1:
+        st.divider()
+        vista = st.selectbox("Sede", [TUTTE_LE_SEDI] + list(BASI), key="sede_vista")
+        if vista == TUTTE_LE_SEDI:
+            sede_nuovi = st.selectbox("Nuovi record in", list(BASI), key="sede_nuovi")
+            store = get_sedi(API_KEY, tuple(BASI.items()), sede_nuovi)
+        else:
+            store = get_sedi(API_KEY, ((vista, BASI[vista]),), vista)
     st.divider(); st.caption("App v109 - Tartaruga")
+    badge_dati = st.empty()
+segna("sidebar")
 
 # =========================================================
 # DASHBOARD
@@ -225,83 +486,30 @@ if menu == "⚡ Dashboard":
     st.write("")
     
     # --- PREPARAZIONE DATI ---
-    # CARICAMENTO LENTO SEQUENZIALE
-    df_pres_alert = get_data("Prestiti")
-    
-    scaduti = pd.DataFrame()
-    if not df_pres_alert.empty:
-        if 'Restituito' not in df_pres_alert.columns: df_pres_alert['Restituito'] = False
-        if 'Data_Scadenza' not in df_pres_alert.columns: df_pres_alert['Data_Scadenza'] = None
-        if 'Oggetto' not in df_pres_alert.columns: df_pres_alert['Oggetto'] = "Strumento"
-        if 'Paziente' not in df_pres_alert.columns: df_pres_alert['Paziente'] = "Sconosciuto"
-        
-        df_pres_alert['Data_Scadenza'] = pd.to_datetime(df_pres_alert['Data_Scadenza'], errors='coerce')
-        oggi_ts = pd.Timestamp.now().normalize()
-        
-        scaduti = df_pres_alert[
-            (df_pres_alert['Restituito'] != True) & 
-            (df_pres_alert['Data_Scadenza'] < oggi_ts) &
-            (df_pres_alert['Data_Scadenza'].notna())
-        ]
+    # Le regole (recall, scadenze, scorte) stanno in logica.py, condivise con cli.py
+    df_pres_alert = logica.prepara_prestiti(get_data("Prestiti"))
+    scaduti = logica.prestiti_scaduti(df_pres_alert)
 
     if 'kpi_filter' not in st.session_state: st.session_state.kpi_filter = "None"
 
-    df = get_data("Pazienti")
-    # Carichiamo gli altri solo se strettamente necessario per le KPI o se serve
-    # Riduciamo il carico in dashboard
+    df = logica.prepara_pazienti(get_data("Pazienti"))
     
     if not df.empty:
-        for col in ['Disdetto', 'Visita_Esterna']:
-            if col not in df.columns: df[col] = False
-            df[col] = df[col].fillna(False)
-        for col in ['Data_Disdetta', 'Data_Visita']:
-            if col not in df.columns: df[col] = None
-            df[col] = pd.to_datetime(df[col], errors='coerce')
-        if 'Area' not in df.columns: df['Area'] = None
-
-        totali = len(df)
-        df_disdetti = df[ (df['Disdetto'] == True) | (df['Disdetto'] == 1) ]
-        cnt_attivi = totali - len(df_disdetti)
-        oggi = pd.Timestamp.now().normalize()
-        
-        limite_recall = oggi - pd.Timedelta(days=7)
-        da_richiamare = df_disdetti[ (df_disdetti['Data_Disdetta'].notna()) & (df_disdetti['Data_Disdetta'] <= limite_recall) ]
-        df_visite = df[ (df['Visita_Esterna'] == True) | (df['Visita_Esterna'] == 1) ]
-        
-        curr_week = oggi.isocalendar()[1]
-        visite_settimana = df_visite[ df_visite['Data_Visita'].apply(lambda x: x.isocalendar()[1] if pd.notnull(x) else -1) == curr_week ]
-        visite_da_reinserire = df_visite[ (df_visite['Data_Visita'].notna()) & (oggi >= (df_visite['Data_Visita'] + pd.Timedelta(days=2))) ]
+        oggi = logica.oggi_ts()
+        df_disdetti = logica.disdetti(df)
+        cnt_attivi = len(df) - len(df_disdetti)
+        da_richiamare = logica.da_richiamare(df, oggi)
+        df_visite = logica.visite_esterne(df)
+        visite_settimana = logica.visite_settimana(df, oggi)
+        visite_da_reinserire = logica.visite_da_reinserire(df, oggi)
 
-        # Carichiamo gli altri dati SOLO dopo aver elaborato i pazienti (Pausa strategica implicita)
-        df_prev = get_data("Preventivi_Salvati")
+        df_prev = logica.prepara_preventivi(get_data("Preventivi_Salvati"))
         cnt_prev = len(df_prev)
-        prev_scaduti = pd.DataFrame()
-        if not df_prev.empty:
-            df_prev['Data_Creazione'] = pd.to_datetime(df_prev['Data_Creazione'], errors='coerce')
-            limite_prev = oggi - timedelta(days=7)
-            prev_scaduti = df_prev[df_prev['Data_Creazione'] <= limite_prev]
+        prev_scaduti = logica.preventivi_scaduti(df_prev, oggi)
 
-        df_inv = get_data("Inventario")
-        low_stock = pd.DataFrame()
-        if not df_inv.empty:
-            if 'Quantità' in df_inv.columns: df_inv = df_inv.rename(columns={'Quantità': 'Quantita'})
-            for c in ['Quantita', 'Soglia_Minima', 'Materiali']:
-                if c not in df_inv.columns: df_inv[c] = 0
-            low_stock = df_inv[df_inv['Quantita'] <= df_inv['Soglia_Minima']]
-
-        df_cons = get_data("Consegne")
-        consegne_pendenti = pd.DataFrame()
-        if not df_cons.empty:
-            if 'Completato' not in df_cons.columns: df_cons['Completato'] = False
-            if 'Data_Scadenza' not in df_cons.columns: df_cons['Data_Scadenza'] = None
-            if 'Paziente' not in df_cons.columns: df_cons['Paziente'] = None
-            
-            # Fix sicurezza
-            if 'Area' not in df_cons.columns: df_cons['Area'] = "Altro"
-            
-            df_cons = df_cons.dropna(subset=['Paziente'])
-            df_cons['Data_Scadenza'] = pd.to_datetime(df_cons['Data_Scadenza'], errors='coerce')
-            consegne_pendenti = df_cons[df_cons['Completato'] != True]
+        # Sotto soglia oppure ci arriveranno entro GIORNI_PREAVVISO_SCORTE al ritmo di consumo attuale
+        low_stock = logica.scorte_in_esaurimento(logica.prepara_inventario(get_data("Inventario")), tassi_consumi())
+        consegne_pendenti = logica.consegne_pendenti(logica.prepara_consegne(get_data("Consegne")))
 
         col1, col2, col3, col4, col5 = st.columns(5)
         def draw_kpi(col, icon, num, label, color, filter_key):
@@ -315,13 +523,20 @@ if menu == "⚡ Dashboard":
         draw_kpi(col4, "🩺", len(df_visite), "Visite", "#0bc5ea", "Visite")
         draw_kpi(col5, "💳", cnt_prev, "Preventivi", "#9f7aea", "Preventivi")
 
+        # Vista di gruppo: gli stessi numeri divisi per sede
+        if store.multipla:
+            def per_sede(d): return d.groupby(COLONNA_SEDE).size() if COLONNA_SEDE in d.columns else pd.Series(dtype=int)
+            tab_sedi = pd.DataFrame({"Attivi": per_sede(logica.attivi(df)), "Disdetti": per_sede(df_disdetti), "Recall": per_sede(da_richiamare),
+                                     "Visite": per_sede(df_visite), "Preventivi": per_sede(df_prev)}).reindex(list(store.stores)).fillna(0).astype(int)
+            with st.expander("🏥 Dettaglio per sede"): st.dataframe(tab_sedi, use_container_width=True)
+
         st.write("")
         if st.session_state.kpi_filter != "None":
             st.divider(); c_head, c_close = st.columns([9, 1])
             c_head.subheader(f"📋 Lista: {st.session_state.kpi_filter}")
             if c_close.button("❌"): st.session_state.kpi_filter = "None"; st.rerun()
             df_show = pd.DataFrame()
-            if st.session_state.kpi_filter == "Attivi": df_show = df[ (df['Disdetto'] == False) | (df['Disdetto'] == 0) ]
+            if st.session_state.kpi_filter == "Attivi": df_show = logica.attivi(df)
             elif st.session_state.kpi_filter == "Disdetti": df_show = df_disdetti
             elif st.session_state.kpi_filter == "Recall": df_show = da_richiamare
             elif st.session_state.kpi_filter == "Visite": df_show = df_visite
@@ -329,6 +544,7 @@ if menu == "⚡ Dashboard":
             if not df_show.empty: 
                 cols_to_show = ['Nome', 'Cognome', 'Area', 'Data_Disdetta', 'Data_Visita']
                 if st.session_state.kpi_filter == "Preventivi": cols_to_show = ['Paziente', 'Data_Creazione', 'Totale']
+                if store.multipla: cols_to_show = [COLONNA_SEDE] + cols_to_show
                 valid_show = [c for c in cols_to_show if c in df_show.columns]
                 st.dataframe(df_show[valid_show], use_container_width=True, height=250)
             else: st.info("Nessun dato.")
@@ -337,29 +553,50 @@ if menu == "⚡ Dashboard":
         st.write("")
         st.subheader("🔔 Avvisi e Scadenze")
         
+        # Ogni gruppo di avvisi è un fragment: un click ridisegna solo il suo
+        # gruppo. Le righe già gestite in questa sessione vengono nascoste
+        # finché il prossimo giro completo della pagina non ricarica i dati.
+        st.session_state.avvisi_gestiti = set()
+
+        def gestito(rid):
+            st.session_state.avvisi_gestiti.add(rid)
+            st.rerun(scope="fragment")
+
+        def da_gestire(rows):
+            return rows[~rows['id'].isin(st.session_state.avvisi_gestiti)]
+
         # 1. DISDETTE / RECALL (Ordine Richiesto: 1)
-        if not da_richiamare.empty:
-            st.caption(f"📞 Recall Necessari: {len(da_richiamare)}")
-            for i, row in da_richiamare.iterrows():
+        @st.fragment
+        def avvisi_recall(rows):
+            rows = da_gestire(rows)
+            if rows.empty: return
+            st.caption(f"📞 Recall Necessari: {len(rows)}")
+            for i, row in rows.iterrows():
                 c_info, c_btn1, c_btn2 = st.columns([3, 1, 1], gap="small")
                 with c_info: st.markdown(f"""<div class="alert-row-name border-orange">{row['Nome']} {row['Cognome']}</div>""", unsafe_allow_html=True)
                 with c_btn1:
-                    if st.button("✅ Rientrato", key=f"rk_{row['id']}", type="primary", use_container_width=True): update_generic("Pazienti", row['id'], {"Disdetto": False, "Data_Disdetta": None}); st.rerun()
+                    if st.button("✅ Rientrato", key=f"rk_{row['id']}", type="primary", use_container_width=True): update_generic("Pazienti", row['id'], {"Disdetto": False, "Data_Disdetta": None}); gestito(row['id'])
                 with c_btn2: 
-                    if st.button("📅 Rimandare", key=f"pk_{row['id']}", type="secondary", use_container_width=True): update_generic("Pazienti", row['id'], {"Data_Disdetta": str(date.today())}); st.rerun()
-        
-        if not visite_da_reinserire.empty:
-            st.caption(f"🛑 Reinserimento Post-Visita: {len(visite_da_reinserire)}")
-            for i, row in visite_da_reinserire.iterrows():
+                    if st.button("📅 Rimandare", key=f"pk_{row['id']}", type="secondary", use_container_width=True): update_generic("Pazienti", row['id'], {"Data_Disdetta": str(date.today())}); gestito(row['id'])
+
+        @st.fragment
+        def avvisi_post_visita(rows):
+            rows = da_gestire(rows)
+            if rows.empty: return
+            st.caption(f"🛑 Reinserimento Post-Visita: {len(rows)}")
+            for i, row in rows.iterrows():
                 c_info, c_btn1, c_void = st.columns([3, 1, 1], gap="small")
                 with c_info: st.markdown(f"""<div class="alert-row-name border-blue">{row['Nome']} {row['Cognome']} (Visitato il {row['Data_Visita'].strftime('%d/%m')})</div>""", unsafe_allow_html=True)
                 with c_btn1:
-                    if st.button("✅ Rientrato", key=f"vk_{row['id']}", type="primary", use_container_width=True): update_generic("Pazienti", row['id'], {"Visita_Esterna": False, "Data_Visita": None}); st.rerun()
+                    if st.button("✅ Rientrato", key=f"vk_{row['id']}", type="primary", use_container_width=True): update_generic("Pazienti", row['id'], {"Visita_Esterna": False, "Data_Visita": None}); gestito(row['id'])
 
         # 2. CONSEGNE (Ordine Richiesto: 2)
-        if not consegne_pendenti.empty:
-            st.caption(f"📨 Consegne in sospeso: {len(consegne_pendenti)}")
-            for i, row in consegne_pendenti.iterrows():
+        @st.fragment
+        def avvisi_consegne(rows):
+            rows = da_gestire(rows)
+            if rows.empty: return
+            st.caption(f"📨 Consegne in sospeso: {len(rows)}")
+            for i, row in rows.iterrows():
                 c_info, c_btn1, c_void = st.columns([3, 1, 1], gap="small")
                 scad_str = row['Data_Scadenza'].strftime('%d/%m') if pd.notnull(row['Data_Scadenza']) else "N.D."
                 with c_info: 
@@ -367,39 +604,53 @@ if menu == "⚡ Dashboard":
                 with c_btn1:
                     if st.button("✅ Fatto", key=f"ok_dash_{row['id']}", type="secondary", use_container_width=True):
                         update_generic("Consegne", row['id'], {"Completato": True})
-                        st.rerun()
-
-        # 3. PRESTITI (Ordine Richiesto: 3)
-        if not scaduti.empty:
-             st.caption(f"⚠️ Prestiti Scaduti: {len(scaduti)}")
-             for i, row in scaduti.iterrows():
-                data_str = row['Data_Scadenza'].strftime('%d/%m') if pd.notnull(row['Data_Scadenza']) else "N.D."
-                st.markdown(f"""<div class="alert-row-name border-red">🔴 {row['Oggetto']} - {row['Paziente']} (Scaduto il {data_str})</div>""", unsafe_allow_html=True)
+                        gestito(row['id'])
 
         # 4. PAGAMENTI / PREVENTIVI SCADUTI (Ordine Richiesto: 4)
-        if not prev_scaduti.empty:
-            st.caption(f"⏳ Preventivi > 7gg: {len(prev_scaduti)}")
-            for i, row in prev_scaduti.iterrows():
+        @st.fragment
+        def avvisi_preventivi(rows):
+            rows = da_gestire(rows)
+            if rows.empty: return
+            st.caption(f"⏳ Preventivi > 7gg: {len(rows)}")
+            for i, row in rows.iterrows():
                 c_info, c_btn1, c_btn2 = st.columns([3, 1, 1], gap="small")
                 with c_info: st.markdown(f"""<div class="alert-row-name border-purple">{row['Paziente']} ({row['Data_Creazione'].strftime('%d/%m')})</div>""", unsafe_allow_html=True)
                 with c_btn1:
-                    if st.button("📞 Rinnova", key=f"ren_{row['id']}", type="primary", use_container_width=True): update_generic("Preventivi_Salvati", row['id'], {"Data_Creazione": str(date.today())}); st.rerun()
+                    if st.button("📞 Rinnova", key=f"ren_{row['id']}", type="primary", use_container_width=True): update_generic("Preventivi_Salvati", row['id'], {"Data_Creazione": str(date.today())}); gestito(row['id'])
                 with c_btn2:
-                    if st.button("🗑️ Elimina", key=f"del_prev_{row['id']}", type="secondary", use_container_width=True): delete_generic("Preventivi_Salvati", row['id']); st.rerun()
+                    if st.button("🗑️ Elimina", key=f"del_prev_{row['id']}", type="secondary", use_container_width=True): delete_generic("Preventivi_Salvati", row['id']); gestito(row['id'])
 
         # 5. INVENTARIO (Ordine Richiesto: 5)
-        if not low_stock.empty:
-            st.caption(f"⚠️ Prodotti in esaurimento: {len(low_stock)}")
-            for i, row in low_stock.iterrows():
+        @st.fragment
+        def avvisi_scorte(rows):
+            rows = da_gestire(rows)
+            if rows.empty: return
+            st.caption(f"⚠️ Prodotti in esaurimento: {len(rows)}")
+            for i, row in rows.iterrows():
                 c_info, c_btn, c_void = st.columns([3, 1, 1], gap="small")
                 with c_info:
                     mat_name = row.get('Materiali', 'Sconosciuto')
-                    st.markdown(f"""<div class="alert-row-name border-yellow">{mat_name} (Qta: {row.get('Quantita',0)})</div>""", unsafe_allow_html=True)
+                    previsto = f", soglia tra ~{row['Giorni_Soglia']:.0f} gg" if row['Giorni_Soglia'] > 0 else ""
+                    st.markdown(f"""<div class="alert-row-name border-yellow">{mat_name} (Qta: {int(row.get('Quantita',0))}{previsto})</div>""", unsafe_allow_html=True)
                 with c_btn:
                     if st.button("🔄 Riordinato", key=f"restock_{row['id']}", type="primary", use_container_width=True):
                         target = int(row.get('Obiettivo', 5))
-                        update_generic("Inventario", row['id'], {"Quantità": target})
-                        st.rerun()
+                        aggiorna_quantita(row['id'], target, "Riordino")
+                        gestito(row['id'])
+
+        if not da_richiamare.empty: avvisi_recall(da_richiamare)
+        if not visite_da_reinserire.empty: avvisi_post_visita(visite_da_reinserire)
+        if not consegne_pendenti.empty: avvisi_consegne(consegne_pendenti)
+
+        # 3. PRESTITI (Ordine Richiesto: 3)
+        if not scaduti.empty:
+             st.caption(f"⚠️ Prestiti Scaduti: {len(scaduti)}")
+             for i, row in scaduti.iterrows():
+                data_str = row['Data_Scadenza'].strftime('%d/%m') if pd.notnull(row['Data_Scadenza']) else "N.D."
+                st.markdown(f"""<div class="alert-row-name border-red">🔴 {row['Oggetto']} - {row['Paziente']} (Scaduto il {data_str})</div>""", unsafe_allow_html=True)
+
+        if not prev_scaduti.empty: avvisi_preventivi(prev_scaduti)
+        if not low_stock.empty: avvisi_scorte(low_stock)
 
         # (Extra) Visite Settimana - in fondo
         if not visite_settimana.empty:
@@ -411,29 +662,47 @@ if menu == "⚡ Dashboard":
         
         st.divider()
 
-        # GRAFICO
+        # GRAFICO (dai rollup giornalieri, non più ricalcolato dai pazienti)
         st.subheader("📈 Performance Aree")
-        df_attivi = df[ (df['Disdetto'] == False) | (df['Disdetto'] == 0) ]
-        all_areas = []
-        if 'Area' in df_attivi.columns:
-            for item in df_attivi['Area'].dropna():
-                if isinstance(item, list): all_areas.extend(item)
-                elif isinstance(item, str): all_areas.extend([p.strip() for p in item.split(',')])
-                else: all_areas.append(str(item))
+        try: aggiorna_rollup(str(date.today()))
+        except Exception as e:
+            log.exception("Aggiornamento rollup fallito")
+            st.warning(f"⚠️ Storico non aggiornato ({e}): i grafici mostrano gli ultimi rollup salvati.")
+        c_range, _ = st.columns([1, 3])
+        periodo = c_range.selectbox("Periodo", ["Oggi", "3 mesi", "6 mesi", "12 mesi", "24 mesi"], label_visibility="collapsed")
+        domain = ["Mano-Polso", "Muscolo-Scheletrico", "Colonna", "ATM", "Gruppi", "Ortopedico"]
+        range_ = ["#0bc5ea", "#9f7aea", "#ecc94b", "#2ecc71", "#e53e3e", "#4a5568"]
         
-        if all_areas:
-            counts = pd.Series(all_areas).value_counts().reset_index()
-            counts.columns = ['Area', 'Pazienti']
-            domain = ["Mano-Polso", "Muscolo-Scheletrico", "Colonna", "ATM", "Gruppi", "Ortopedico"]
-            range_ = ["#0bc5ea", "#9f7aea", "#ecc94b", "#2ecc71", "#e53e3e", "#4a5568"]
-            chart = alt.Chart(counts).mark_bar(cornerRadius=6, height=35).encode(
-                x=alt.X('Pazienti', axis=None),
-                y=alt.Y('Area', sort='-x', title=None, axis=alt.Axis(domain=False, ticks=False, labelColor="#cbd5e0", labelFontSize=14)),
-                color=alt.Color('Area', scale=alt.Scale(domain=domain, range=range_), legend=None),
-                tooltip=['Area', 'Pazienti']
-            ).properties(height=400).configure(background='transparent').configure_view(strokeWidth=0).configure_axis(grid=False)
-            st.altair_chart(chart, use_container_width=True, theme=None)
-        else: st.info("Dati insufficienti.")
+        if periodo == "Oggi":
+            counts = rollup.leggi_aree(oggi)
+            counts = counts[counts['attivi'] > 0].rename(columns={'area': 'Area', 'attivi': 'Pazienti'})
+            if not counts.empty:
+                chart = alt.Chart(counts).mark_bar(cornerRadius=6, height=35).encode(
+                    x=alt.X('Pazienti', axis=None),
+                    y=alt.Y('Area', sort='-x', title=None, axis=alt.Axis(domain=False, ticks=False, labelColor="#cbd5e0", labelFontSize=14)),
+                    color=alt.Color('Area', scale=alt.Scale(domain=domain, range=range_), legend=None),
+                    tooltip=['Area', 'Pazienti']
+                ).properties(height=400).configure(background='transparent').configure_view(strokeWidth=0).configure_axis(grid=False)
+                st.altair_chart(chart, use_container_width=True, theme=None)
+            else: st.info("Dati insufficienti.")
+        else:
+            da = oggi - pd.DateOffset(months=int(periodo.split()[0]))
+            trend = rollup.leggi_aree(da).rename(columns={'giorno': 'Giorno', 'area': 'Area', 'attivi': 'Attivi', 'disdetti': 'Disdetti'})
+            if trend['Giorno'].nunique() > 1:
+                chart = alt.Chart(trend).mark_line(strokeWidth=3).encode(
+                    x=alt.X('Giorno:T', title=None, axis=alt.Axis(labelColor="#cbd5e0", format="%d/%m/%y")),
+                    y=alt.Y('Attivi', title=None, axis=alt.Axis(labelColor="#cbd5e0")),
+                    color=alt.Color('Area', scale=alt.Scale(domain=domain, range=range_), legend=alt.Legend(labelColor="#cbd5e0", title=None, orient="bottom")),
+                    tooltip=[alt.Tooltip('Giorno:T', format="%d/%m/%Y"), 'Area', 'Attivi', 'Disdetti']
+                ).properties(height=400).configure(background='transparent').configure_view(strokeWidth=0).configure_axis(grid=False)
+                st.altair_chart(chart, use_container_width=True, theme=None)
+                
+                giorni = rollup.leggi_giorni(da)
+                r1, r2, r3 = st.columns(3)
+                r1.metric("Recall medi/giorno", f"{giorni['recall'].mean():.1f}")
+                r2.metric("Prestiti fuori (media)", f"{giorni['prestiti_fuori'].mean():.1f}")
+                r3.metric("Preventivi creati", int(giorni['preventivi_creati'].sum()))
+            else: st.info("Storico in costruzione: i rollup si accumulano un giorno alla volta.")
 
 # =========================================================
 # SEZIONE 2: PAZIENTI
@@ -487,7 +756,62 @@ elif menu == "👥 Pazienti":
                 if str(row['Data_Visita']) != str(orig['Data_Visita']): changes['Data_Visita'] = row['Data_Visita']
                 if row['Area'] != orig['Area']: changes['Area'] = row['Area']
                 if changes: update_generic("Pazienti", rec_id, changes); count_upd += 1
-            if count_upd > 0 or count_del > 0: get_data.clear(); st.toast("Database aggiornato!", icon="✅"); st.rerun()
+            if count_upd > 0 or count_del > 0: st.toast("Database aggiornato!", icon="✅"); st.rerun()
+
+    # --- SCHEDA PAZIENTE (360°) ---
+    st.write("")
+    with st.container(border=True):
+        st.subheader("🔎 Scheda Paziente")
+        for t in TABELLE_COLLEGATE: get_data(t, solo_carica=True)
+        nomi_paz = nomi_pazienti()
+        pid = scegli_paziente(st, "Paziente", nomi_paz, key="scheda_paz")
+        if pid:
+            indice = indice_pazienti(tuple(store.version(t) for t in ["Pazienti"] + TABELLE_COLLEGATE))
+            rec_paz = store.record("Pazienti", pid) or {}
+            st.caption(f"Area: {rec_paz.get('Area') or 'N.D.'} · {'🔴 Disdetto' if rec_paz.get('Disdetto') else '🟢 Attivo'}")
+            c_pres, c_cons, c_prev = st.columns(3)
+            with c_pres:
+                st.markdown("**🔄 Prestiti**")
+                righe = [store.record("Prestiti", rid) or {} for rid in indice.record_ids("Prestiti", pid)]
+                if not righe: st.caption("Nessun prestito.")
+                for f in sorted(righe, key=lambda f: str(f.get('Data_Prestito', '')), reverse=True):
+                    stato = "✅ Restituito" if f.get('Restituito') else "🔴 In corso"
+                    st.write(f"{f.get('Oggetto', '?')} · {f.get('Data_Prestito', 'N.D.')} → {f.get('Data_Scadenza', 'N.D.')} · {stato}")
+            with c_cons:
+                st.markdown("**📨 Consegne**")
+                righe = [store.record("Consegne", rid) or {} for rid in indice.record_ids("Consegne", pid)]
+                if not righe: st.caption("Nessuna consegna.")
+                for f in sorted(righe, key=lambda f: str(f.get('Data_Scadenza', ''))):
+                    stato = "✅" if f.get('Completato') else "⏳"
+                    st.write(f"{stato} {f.get('Indicazione', '')} ({f.get('Area', '')}, entro {f.get('Data_Scadenza', 'N.D.')})")
+            with c_prev:
+                st.markdown("**💳 Preventivi**")
+                righe = [store.record("Preventivi_Salvati", rid) or {} for rid in indice.record_ids("Preventivi_Salvati", pid)]
+                if not righe: st.caption("Nessun preventivo.")
+                for f in sorted(righe, key=lambda f: str(f.get('Data_Creazione', '')), reverse=True):
+                    st.write(f"{f.get('Data_Creazione', 'N.D.')} · {f.get('Totale', 0)}€")
+
+    # --- MIGRAZIONE: dal nome testuale al record id ---
+    with st.expander("🔗 Collega record esistenti ai pazienti"):
+        st.caption("Prestiti, Consegne e Preventivi salvati prima del collegamento hanno solo il nome del paziente: qui vengono collegati al record in Pazienti.")
+        # Il corpo dell'expander gira a ogni rerun anche da chiuso: il confronto
+        # dei nomi parte solo su richiesta
+        analizza = st.toggle("Cerca record da collegare", key="migra_analizza")
+        piani = piano_collegamenti(tuple(store.version(t) for t in ["Pazienti"] + TABELLE_COLLEGATE)) if analizza else {}
+        for t, (da_collegare, irrisolti) in piani.items():
+            c_t, c_btn = st.columns([4, 1])
+            c_t.write(f"**{t}**: {da_collegare} da collegare, {len(irrisolti)} non risolti (nome assente, sconosciuto o omonimo)")
+            if da_collegare and c_btn.button("Collega", key=f"migra_{t}"):
+                ok = False
+                with st.spinner(f"Collegamento {t}..."):
+                    try:
+                        n = sum(migra(s, t, s.records("Pazienti"))[0] for s in store.stores.values())
+                        st.toast(f"{t}: {n} record collegati", icon="✅"); ok = True
+                    except Exception as e: st.error(f"Errore {t}: {e}")
+                if ok: st.rerun()
+            if irrisolti:
+                with st.popover("Vedi non risolti"):
+                    for _, nome, n in irrisolti[:100]: st.write(f"{nome or '(vuoto)'} — {'omonimi' if n > 1 else 'non trovato'}")
 
 # =========================================================
 # SEZIONE 3: PREVENTIVI
@@ -557,11 +881,12 @@ elif menu == "💳 Preventivi":
                         st.session_state.last_std_pkg = scelta_std
                         st.rerun()
 
-            nomi_pazienti = ["Seleziona..."] + sorted([f"{r['Cognome']} {r['Nome']}" for i, r in df_paz.iterrows()]) if not df_paz.empty else []
+            nomi_paz = nomi_pazienti()
             c_paz, c_serv = st.columns([1, 2])
             
             with c_paz:
-                paziente_scelto = st.selectbox("Intestato a:", nomi_pazienti)
+                paziente_id = scegli_paziente(st, "Intestato a:", nomi_paz)
+                paziente_scelto = nomi_paz.get(paziente_id, "")
             
             with c_serv:
                 servizi_scelti = st.multiselect("Trattamenti:", all_services_list, key="prev_selected_services")
@@ -654,10 +979,9 @@ elif menu == "💳 Preventivi":
                 
                 with c_btn:
                     if st.button("💾 Salva Preventivo", type="primary", use_container_width=True):
-                        if paziente_scelto != "Seleziona...":
+                        if paziente_id:
                             dett = " | ".join([f"{r['nome']} x{r['qty']} ({r['tot']}€)" for r in righe])
-                            save_preventivo_temp(paziente_scelto, dett, tot, note_preventivo)
-                            st.success("Salvato!")
+                            if save_preventivo_temp(paziente_scelto, dett, tot, note_preventivo, paziente_id): st.success("Salvato!")
                         else: st.error("Seleziona un paziente.")
                     
                     if st.button("🖨️ Anteprima Stampa", use_container_width=True):
@@ -727,66 +1051,73 @@ elif menu == "📨 Consegne":
     st.title("📨 Consegne Pazienti")
     df_cons = get_data("Consegne")
     df_paz = get_data("Pazienti")
-    nomi_paz = ["-- Seleziona --"] + sorted([f"{r['Cognome']} {r['Nome']}" for i, r in df_paz.iterrows()]) if not df_paz.empty else []
+    nomi_paz = nomi_pazienti()
     
     with st.expander("➕ Nuova Consegna", expanded=True):
         with st.form("new_cons"):
             c1, c2 = st.columns(2)
-            paz = c1.selectbox("Paziente", nomi_paz)
+            paz = scegli_paziente(c1, "Paziente", nomi_paz)
             # AGGIUNTA "Segreteria" QUI SOTTO
             area = c2.selectbox("Area Competenza", ["Mano-Polso", "Colonna", "ATM", "Muscolo-Scheletrico", "Segreteria"])
             ind = st.text_input("Cosa consegnare? (es. Referto, Scheda Esercizi)")
             scad = st.date_input("Entro quando?", date.today() + timedelta(days=3))
             if st.form_submit_button("Salva Promemoria"):
-                if paz != "-- Seleziona --" and ind:
-                    save_consegna(paz, area, ind, scad); st.success("Salvato!"); st.rerun()
+                if paz and ind:
+                    if save_consegna(nomi_paz[paz], area, ind, scad, paz): st.success("Salvato!"); st.rerun()
                 else: st.error("Compila i campi.")
 
     st.write("")
     
     # AGGIUNTA "Segreteria" NELLE TABS E NEL MAPPING
-    tabs = st.tabs(["Mano-Polso", "Colonna", "ATM", "Muscolo-Scheletrico", "Segreteria"])
     mapping = ["Mano-Polso", "Colonna", "ATM", "Muscolo-Scheletrico", "Segreteria"]
+    PAGINA_CONSEGNE = 15
     
-    if not df_cons.empty:
-        # --- FIX PER EVITARE KEYERROR SE MANCANO COLONNE ---
-        if 'Area' not in df_cons.columns: df_cons['Area'] = "Altro"
-        if 'Data_Scadenza' not in df_cons.columns: df_cons['Data_Scadenza'] = None
-        if 'Completato' not in df_cons.columns: df_cons['Completato'] = False
-        
-        # Conversione sicura della data
-        df_cons['Data_Scadenza'] = pd.to_datetime(df_cons['Data_Scadenza'], errors='coerce').dt.date
-        
-        for i, tab_name in enumerate(mapping):
-            with tabs[i]:
-                # Filtra per l'area specifica della tab corrente
-                items = df_cons[ (df_cons['Area'] == tab_name) & (df_cons['Completato'] != True) ]
-                
-                if items.empty: 
-                    st.info(f"Nessuna consegna in attesa per {tab_name}.")
+    # Indice costruito una volta per caricamento: pendenti ordinati per
+    # scadenza e divisi per area, stato calcolato in un solo passaggio.
+    indice = logica.indice_consegne(df_cons)
+    labels = []
+    for area in mapping:
+        gruppo = indice.get(area)
+        n = 0 if gruppo is None else len(gruppo)
+        n_scad = 0 if gruppo is None else int((gruppo['Stato'] == "scaduto").sum())
+        labels.append(f"{area} ({n})" + (f" 🔴{n_scad}" if n_scad else ""))
+    tabs = st.tabs(labels)
+    
+    if 'cons_pagine' not in st.session_state: st.session_state.cons_pagine = {}
+    
+    for i, tab_name in enumerate(mapping):
+        with tabs[i]:
+            items = indice.get(tab_name)
+            
+            if items is None: 
+                st.info(f"Nessuna consegna in attesa per {tab_name}.")
+                continue
+            
+            limite = st.session_state.cons_pagine.get(tab_name, PAGINA_CONSEGNE)
+            for row in items.head(limite).itertuples(index=False):
+                if row.Stato == "nd":
+                    status_text = "Data non definita"
+                    date_display = "N.D."
                 else:
-                    for _, row in items.iterrows():
-                        # Calcolo giorni mancanti o ritardo
-                        if row['Data_Scadenza']:
-                            delta = (row['Data_Scadenza'] - date.today()).days
-                            status_text = f"Scade tra {delta} gg" if delta >= 0 else f"SCADUTO da {abs(delta)} gg"
-                            color = "border-green" if delta > 3 else "border-yellow" if delta >= 0 else "border-red"
-                            date_display = row['Data_Scadenza'].strftime('%d/%m')
-                        else:
-                            status_text = "Data non definita"
-                            color = "border-gray"
-                            date_display = "N.D."
-                        
-                        # Layout riga
-                        c_chk, c_info, c_date = st.columns([1, 6, 2])
-                        with c_chk:
-                            if st.button("✅", key=f"ok_{row['id']}"):
-                                update_generic("Consegne", row['id'], {"Completato": True})
-                                st.rerun()
-                        with c_info:
-                            st.markdown(f"""<div class="alert-row-name {color}"><b>{row.get('Paziente', 'Sconosciuto')}</b>: {row.get('Indicazione', '')}</div>""", unsafe_allow_html=True)
-                        with c_date:
-                            st.caption(f"{date_display}\n({status_text})")
+                    delta = int(row.Giorni)
+                    status_text = f"Scade tra {delta} gg" if delta >= 0 else f"SCADUTO da {abs(delta)} gg"
+                    date_display = row.Data_Scadenza.strftime('%d/%m')
+                
+                # Layout riga
+                c_chk, c_info, c_date = st.columns([1, 6, 2])
+                with c_chk:
+                    if st.button("✅", key=f"ok_{row.id}"):
+                        update_generic("Consegne", row.id, {"Completato": True})
+                        st.rerun()
+                with c_info:
+                    st.markdown(f"""<div class="alert-row-name {logica.COLORI_STATO_CONSEGNA[row.Stato]}"><b>{row.Paziente}</b>: {row.Indicazione}</div>""", unsafe_allow_html=True)
+                with c_date:
+                    st.caption(f"{date_display}\n({status_text})")
+            
+            if len(items) > limite:
+                if st.button(f"Mostra altre ({len(items) - limite})", key=f"more_cons_{tab_name}"):
+                    st.session_state.cons_pagine[tab_name] = limite + PAGINA_CONSEGNE
+                    st.rerun()
 
 # =========================================================
 # SEZIONE 4: MAGAZZINO (MODIFICATA CON + E -)
@@ -794,6 +1125,8 @@ elif menu == "📨 Consegne":
 elif menu == "📦 Magazzino":
     st.title("Magazzino & Materiali")
     STANZE = ["Segreteria", "Mano", "Stanze", "Medicinali", "Pulizie"]
+    # CSS delle card iniettato una volta per pagina (non una volta per articolo)
+    st.markdown('<style>div[data-testid="stVerticalBlockBorderWrapper"] {padding: 8px 15px !important; margin-bottom: 5px !important;}</style>', unsafe_allow_html=True)
     col_add, col_view = st.columns([1, 2])
     
     with col_add:
@@ -811,6 +1144,44 @@ elif menu == "📦 Magazzino":
                         save_materiale_avanzato(new_mat, new_area, qty_now, qty_target, qty_min)
                         st.success("Aggiunto!"); st.rerun()
 
+    # Ogni articolo è un fragment: 🔺/🔻 ridisegnano solo la propria card,
+    # rileggendo il record aggiornato dallo store condiviso.
+    @st.fragment
+    def card_articolo(rid, consumo_giorno=0.0):
+        rec = store.record("Inventario", rid)
+        if rec is None: return
+        quantita = int(rec.get('Quantità') or 0)
+        obiettivo = int(rec.get('Obiettivo') or 0)
+        soglia = int(rec.get('Soglia_Minima') or 0)
+        is_low = quantita <= soglia
+        with st.container(border=True):
+            c_info, c_stat, c_act = st.columns([3, 2, 1], gap="small")
+            with c_info:
+                mat_name = rec.get('Materiali', 'Senza Nome')
+                st.markdown(f"**{mat_name}** · {store.sede_di(rid)}" if store.multipla else f"**{mat_name}**")
+                if is_low: st.caption(":red[⚠️ BASSO]")
+                elif consumo_giorno > 0: st.caption(f":green[OK] · soglia tra ~{(quantita - soglia) / consumo_giorno:.0f} gg")
+                else: st.caption(":green[OK]")
+            with c_stat:
+                val = min(quantita / max(obiettivo, 1), 1.0)
+                st.progress(val)
+                st.caption(f"**{quantita}** / {obiettivo}")
+            with c_act:
+                st.write("") 
+                # --- MODIFICA: DUE PULSANTI PER AUMENTO E DIMINUZIONE ---
+                b_minus, b_plus = st.columns(2)
+                
+                with b_minus:
+                    if st.button("🔻", key=f"dec_{rid}", type="secondary", use_container_width=True):
+                        if quantita > 0:
+                            aggiorna_quantita(rid, quantita - 1, "Consumo")
+                            st.rerun(scope="fragment")
+                with b_plus:
+                    # Il tasto ha la freccia verde grazie al CSS aggiunto sopra
+                    if st.button("🔺", key=f"inc_{rid}", type="secondary", use_container_width=True):
+                        aggiorna_quantita(rid, quantita + 1, "Carico")
+                        st.rerun(scope="fragment")
+
     with col_view:
         df_inv = get_data("Inventario")
         if not df_inv.empty:
@@ -819,43 +1190,62 @@ elif menu == "📦 Magazzino":
                 if c not in df_inv.columns: df_inv[c] = 0
             df_inv['Quantita'] = df_inv['Quantita'].fillna(0).astype(int)
             
-            tabs = st.tabs(STANZE)
+            if 'Area' not in df_inv.columns: df_inv['Area'] = None
+            vista_griglia = st.toggle("🧮 Modifica a griglia", key="inv_griglia", help="Modifica Quantità, Obiettivo e Soglia di più articoli e salva tutto insieme")
+            tassi = tassi_consumi()
+            tabs = st.tabs(STANZE + ["🛒 Riordini"])
             for i, stanza in enumerate(STANZE):
                 with tabs[i]:
                     items = df_inv[df_inv['Area'] == stanza]
                     if items.empty: st.caption("Nessun articolo.")
+                    elif vista_griglia:
+                        cols_edit = ['Quantita', 'Obiettivo', 'Soglia_Minima']
+                        col_info = ['Materiali'] + ([COLONNA_SEDE] if store.multipla else [])
+                        orig = items[['id'] + col_info + cols_edit].copy()
+                        for c in cols_edit: orig[c] = pd.to_numeric(orig[c], errors='coerce').fillna(0).astype(int)
+                        orig = orig.set_index('id')
+                        edited = st.data_editor(orig, column_config={
+                            "Materiali": st.column_config.TextColumn("Materiale", disabled=True),
+                            COLONNA_SEDE: st.column_config.TextColumn("Sede", disabled=True),
+                            "Quantita": st.column_config.NumberColumn("Quantità", min_value=0, step=1, required=True),
+                            "Obiettivo": st.column_config.NumberColumn("Obiettivo", min_value=0, step=1, required=True),
+                            "Soglia_Minima": st.column_config.NumberColumn("Soglia Min.", min_value=0, step=1, required=True),
+                        }, hide_index=True, use_container_width=True, num_rows="fixed", key=f"grid_{stanza}")
+                        
+                        # Solo le celle cambiate, raggruppate per record (una cella
+                        # svuotata vale come non modificata)
+                        edited[cols_edit] = edited[cols_edit].fillna(orig[cols_edit])
+                        diff = edited[cols_edit].ne(orig[cols_edit])
+                        modifiche = []
+                        for rid, riga in diff[diff.any(axis=1)].iterrows():
+                            campi = {CAMPI_INVENTARIO[c]: int(edited.at[rid, c]) for c in cols_edit if riga[c]}
+                            modifiche.append({"id": rid, "fields": campi})
+                        if st.button(f"💾 Salva {len(modifiche)} modifiche" if modifiche else "💾 Nessuna modifica", key=f"save_grid_{stanza}", type="primary", disabled=not modifiche):
+                            n = update_batch("Inventario", modifiche)
+                            for rid in diff.index[diff['Quantita']]:
+                                if (store.record("Inventario", rid) or {}).get("Quantità") == int(edited.at[rid, 'Quantita']):
+                                    registra_movimento(rid, orig.at[rid, 'Quantita'], edited.at[rid, 'Quantita'], MOTIVO_RETTIFICA)
+                            # Con errori niente rerun: messaggi visibili e griglia ancora modificata
+                            if n == len(modifiche): st.toast(f"{n} articoli aggiornati", icon="✅"); st.rerun()
+                            else: st.error(f"Salvati {n} articoli su {len(modifiche)}: le altre modifiche non sono state salvate.")
                     else:
-                        for _, row in items.iterrows():
-                            is_low = row['Quantita'] <= row['Soglia_Minima']
-                            with st.container(border=True):
-                                st.markdown('<style>div[data-testid="stVerticalBlockBorderWrapper"] {padding: 8px 15px !important; margin-bottom: 5px !important;}</style>', unsafe_allow_html=True)
-                                c_info, c_stat, c_act = st.columns([3, 2, 1], gap="small")
-                                with c_info:
-                                    mat_name = row.get('Materiali', 'Senza Nome')
-                                    st.markdown(f"**{mat_name}**")
-                                    if is_low: st.caption(":red[⚠️ BASSO]")
-                                    else: st.caption(":green[OK]")
-                                with c_stat:
-                                    val = min(row['Quantita'] / max(row['Obiettivo'], 1), 1.0)
-                                    st.progress(val)
-                                    st.caption(f"**{row['Quantita']}** / {row['Obiettivo']}")
-                                with c_act:
-                                    st.write("") 
-                                    # --- MODIFICA: DUE PULSANTI PER AUMENTO E DIMINUZIONE ---
-                                    b_minus, b_plus = st.columns(2)
-                                    
-                                    with b_minus:
-                                        if st.button("🔻", key=f"dec_{row['id']}", type="secondary", use_container_width=True):
-                                            if row['Quantita'] > 0:
-                                                new_qty = int(row['Quantita'] - 1)
-                                                update_generic("Inventario", row['id'], {"Quantità": new_qty})
-                                                st.rerun()
-                                    with b_plus:
-                                        # Il tasto ha la freccia verde grazie al CSS aggiunto sopra
-                                        if st.button("🔺", key=f"inc_{row['id']}", type="secondary", use_container_width=True):
-                                            new_qty = int(row['Quantita'] + 1)
-                                            update_generic("Inventario", row['id'], {"Quantità": new_qty})
-                                            st.rerun()
+                        for rid in items['id']: card_articolo(rid, tassi.get(rid, 0.0))
+
+            # Lista d'ordine per stanza: sotto soglia o in esaurimento entro l'orizzonte
+            with tabs[-1]:
+                orizzonte = st.slider("Orizzonte (giorni)", 7, 60, 14, step=7, key="inv_orizzonte")
+                riordini = logica.riordini_per_stanza(df_inv, tassi, orizzonte)
+                if not riordini: st.success("Niente da riordinare in questo orizzonte.")
+                for stanza, g in riordini.items():
+                    st.markdown(f"**{stanza}** · {len(g)} articoli")
+                    st.dataframe(g[['Materiali', 'Quantita', 'Soglia_Minima', 'Consumo_Giorno', 'Giorni_Soglia', 'Da_Ordinare']], column_config={
+                        "Materiali": "Materiale", "Quantita": "Quantità", "Soglia_Minima": "Soglia",
+                        "Consumo_Giorno": st.column_config.NumberColumn("Consumo/gg", format="%.2f"),
+                        "Giorni_Soglia": st.column_config.NumberColumn("Giorni alla soglia", format="%.0f"),
+                        "Da_Ordinare": "Da ordinare",
+                    }, hide_index=True, use_container_width=True)
+                in_coda = sum(get_movimenti(API_KEY, s.base_id).in_coda() for s in store.stores.values())
+                st.caption(f"Consumi stimati dal registro Movimenti{f' · {in_coda} movimenti in attesa di invio' if in_coda else ''}.")
         else: st.info("Magazzino vuoto.")
 
 # =========================================================
@@ -863,6 +1253,12 @@ elif menu == "📦 Magazzino":
 # =========================================================
 elif menu == "🔄 Prestiti":
     st.title("Gestione Noleggi e Prestiti")
+    # Gli strumenti (e il loro calendario) sono per sede: nella vista di gruppo
+    # la pagina lavora comunque su una sede alla volta, così "Compex Pro 1" di
+    # una sede non risulta in prestito nelle altre.
+    if store.multipla:
+        sede_prestiti = st.selectbox("Sede", list(store.stores), index=list(store.stores).index(store.predefinita), key="prestiti_sede")
+        store = get_sedi(API_KEY, ((sede_prestiti, BASI[sede_prestiti]),), sede_prestiti)
     
     # 1. INVENTARIO (Definizione Strumenti)
     # IMPORTANTE: Nomi univoci per evitare errori
@@ -878,7 +1274,7 @@ elif menu == "🔄 Prestiti":
     
     df_pres = get_data("Prestiti")
     df_paz = get_data("Pazienti")
-    nomi_paz = ["-- Seleziona --"] + sorted([f"{r['Cognome']} {r['Nome']}" for i, r in df_paz.iterrows()]) if not df_paz.empty else []
+    nomi_paz = nomi_pazienti()
 
     # --- FIX ANTI-CRASH: Assicuriamo che le colonne esistano ---
     if not df_pres.empty:
@@ -887,23 +1283,67 @@ elif menu == "🔄 Prestiti":
         if 'Oggetto' not in df_pres.columns: df_pres['Oggetto'] = "Strumento"
         if 'Paziente' not in df_pres.columns: df_pres['Paziente'] = "Sconosciuto"
 
+    # Oggetti Extra (servono sia per le card sia per le prenotazioni)
+    df_inv_extra = get_data("Inventario")
+    extra_items = []
+    if not df_inv_extra.empty and 'Area' in df_inv_extra.columns:
+         # Filtra quelli con Area = "Extra"
+         extra_items = df_inv_extra[df_inv_extra['Area'] == "Extra"]['Materiali'].dropna().tolist()
+    CATEGORIA_OGGETTO = {o: cat for cat, lista in INVENTARIO.items() for o in lista}
+    CATEGORIA_OGGETTO.update({o: "Extra" for o in extra_items})
+    tutti_oggetti = list(CATEGORIA_OGGETTO)
+
     # KPI TOP
     tot_strumenti = sum(len(v) for v in INVENTARIO.values())
     in_prestito = 0
     in_ritardo = 0
+    prenotati = 0
     if not df_pres.empty:
-        # Conta solo non restituiti
-        in_prestito = len(df_pres[df_pres['Restituito'] != True])
+        # Conta solo non restituiti già partiti (le prenotazioni future a parte)
+        inizio_pres = pd.to_datetime(df_pres['Data_Prestito'], errors='coerce') if 'Data_Prestito' in df_pres.columns else pd.Series(pd.NaT, index=df_pres.index)
+        oggi_ts = pd.Timestamp.now().normalize()
+        aperti = df_pres['Restituito'] != True
+        futuri = inizio_pres > oggi_ts
+        in_prestito = int((aperti & ~futuri).sum())
+        prenotati = int((aperti & futuri).sum())
         # Conta scaduti
         df_pres['Data_Scadenza'] = pd.to_datetime(df_pres['Data_Scadenza'], errors='coerce')
-        in_ritardo = len(df_pres[(df_pres['Restituito'] != True) & (df_pres['Data_Scadenza'] < pd.Timestamp.now().normalize())])
+        in_ritardo = len(df_pres[aperti & (df_pres['Data_Scadenza'] < oggi_ts)])
 
-    kp1, kp2, kp3 = st.columns(3)
+    kp1, kp2, kp3, kp4 = st.columns(4)
     kp1.metric("📦 Totale Strumenti", tot_strumenti)
     kp2.metric("🔄 Attualmente Fuori", in_prestito)
     kp3.metric("⚠️ In Ritardo", in_ritardo, delta_color="inverse")
+    kp4.metric("📅 Prenotazioni", prenotati)
     st.divider()
 
+    # --- PAZIENTE E DURATA: UN SOLO SELETTORE PER TUTTA LA PAGINA ---
+    # Le card non hanno più un selectbox ciascuna con tutti i pazienti: "Presta"
+    # usa la scelta fatta qui (la selectbox è già ricercabile digitando).
+    with st.container(border=True):
+        c_paz, c_num, c_unit = st.columns([3, 1, 1])
+        paz_sel = scegli_paziente(c_paz, "👤 Paziente (prestito / prenotazione)", nomi_paz, key="prestito_paz")
+        c_num.number_input("Durata", 1, 52, 1, key="prestito_durata")
+        c_unit.selectbox("Unità", ["Sett", "Giorni"], key="prestito_unita")
+
+    # --- PRENOTAZIONI FUTURE ---
+    with st.expander("📅 Prenota Strumento", expanded=False):
+        with st.form("prenota"):
+            c_ogg, c_per = st.columns(2)
+            ogg_pren = c_ogg.selectbox("Strumento", tutti_oggetti)
+            periodo = c_per.date_input("Periodo", (date.today() + timedelta(days=7), date.today() + timedelta(days=14)), min_value=date.today(), format="DD/MM/YYYY")
+            st.caption(f"Paziente: {nomi_paz.get(paz_sel, '— scegli sopra —')}")
+            paz_pren = paz_sel
+            if st.form_submit_button("Prenota", type="primary"):
+                if not paz_pren or len(periodo) != 2: st.error("Seleziona paziente (sopra) e periodo (dal / al).")
+                else:
+                    conflitti = calendario_prestiti(store.version("Prestiti"), str(date.today())).conflitti(ogg_pren, periodo[0], periodo[1])
+                    if conflitti:
+                        iv = conflitti[0]
+                        st.error(f"{ogg_pren} è già occupato dal {iv.inizio.strftime('%d/%m')} al {iv.fine.strftime('%d/%m')} ({iv.paziente}).")
+                    elif save_prestito_new(nomi_paz[paz_pren], ogg_pren, CATEGORIA_OGGETTO[ogg_pren], periodo[0], periodo[1], paz_pren):
+                        st.success("Prenotazione registrata!"); st.rerun()
+
     # --- AGGIUNTA OGGETTO NUOVO ---
     with st.expander("➕ Aggiungi Oggetto in Elenco", expanded=False):
         with st.form("add_new_obj_list"):
@@ -918,115 +1358,98 @@ elif menu == "🔄 Prestiti":
                 else:
                     st.warning("Scrivi il nome dell'oggetto.")
 
-    tabs = st.tabs(["✋ Strumenti Mano", "⚡ Elettrostimolatore", "🧲 Magnetoterapia", "📦 Extra / Fuori Lista"])
+    # Ogni strumento è un fragment: "Presta" / "Restituisci" ridisegnano solo
+    # la propria card leggendo i prestiti aperti dallo store condiviso.
+    @st.fragment
+    def card_strumento(strumento, categoria):
+        cal = calendario_prestiti(store.version("Prestiti"), str(date.today()))
+        prestito_attivo = [(iv.id, store.record("Prestiti", iv.id) or {}) for iv in cal.in_corso(strumento)]
+        
+        with st.container(border=True):
+            c_nome, c_stato = st.columns([1, 2])
+            with c_nome:
+                st.markdown(f"### {strumento}")
+                if not prestito_attivo: st.caption("🟢 DISPONIBILE")
+                else: st.caption("🔴 IN PRESTITO")
+
+            with c_stato:
+                if prestito_attivo:
+                    record = prestito_attivo[0][1]
+                    scadenza = pd.to_datetime(record.get('Data_Scadenza')).date() if pd.notnull(record.get('Data_Scadenza')) else date.today()
+                    days_left = (scadenza - date.today()).days
+                    bg_color = "rgba(229, 62, 62, 0.2)" if days_left < 0 else "rgba(46, 204, 113, 0.2)"
+                    
+                    st.markdown(f"""<div style="background-color: {bg_color}; padding: 10px; border-radius: 8px;"><strong>Paziente:</strong> {record.get('Paziente', 'Unknown')}<br><strong>Scadenza:</strong> {scadenza.strftime('%d/%m')} ({days_left} gg)</div>""", unsafe_allow_html=True)
+                    
+                    if st.button("🔄 Restituisci", key=f"ret_{strumento}", use_container_width=True):
+                        with st.spinner("Restituzione in corso..."):
+                            for rid, _ in prestito_attivo:
+                                update_generic("Prestiti", rid, {"Restituito": True})
+                            st.toast(f"{strumento} restituito!"); st.rerun(scope="fragment")
+                else:
+                    prossima = cal.prossima_prenotazione(strumento)
+                    c_info, c_btn = st.columns([2, 1])
+                    with c_info:
+                        if prossima: st.caption(f"📅 Prenotato dal {prossima.inizio.strftime('%d/%m')} al {prossima.fine.strftime('%d/%m')} ({prossima.paziente})")
+                    with c_btn:
+                        if st.button("➕ Presta", key=f"btn_{strumento}", type="primary", use_container_width=True):
+                            # Paziente e durata dal selettore unico in cima alla pagina
+                            paz_sel = st.session_state.get("prestito_paz")
+                            if paz_sel:
+                                num, unit = st.session_state.prestito_durata, st.session_state.prestito_unita
+                                delta = timedelta(weeks=num) if unit == "Sett" else timedelta(days=num)
+                                if not cal.libero(strumento, date.today(), date.today() + delta):
+                                    st.toast(f"Conflitto con la prenotazione del {prossima.inizio.strftime('%d/%m')}: riduci la durata.", icon="⚠️")
+                                elif save_prestito_new(nomi_paz[paz_sel], strumento, categoria, date.today(), date.today() + delta, paz_sel):
+                                    st.toast("Prestito registrato!", icon="✅"); st.rerun(scope="fragment")
+                            else: st.toast("Scegli prima il paziente in cima alla pagina!", icon="⚠️")
+
+    tabs = st.tabs(["✋ Strumenti Mano", "⚡ Elettrostimolatore", "🧲 Magnetoterapia", "📦 Extra / Fuori Lista", "🗓️ Calendario"])
     mappa_tabs = {0: "Strumenti Mano", 1: "Elettrostimolatore", 2: "Magnetoterapia"}
     
     # TAB STANDARD
     for i, tab_name in mappa_tabs.items():
         with tabs[i]:
-            strumenti_categoria = INVENTARIO[tab_name]
-            for strumento in strumenti_categoria:
-                prestito_attivo = pd.DataFrame()
-                if not df_pres.empty:
-                    prestito_attivo = df_pres[ (df_pres['Oggetto'] == strumento) & (df_pres['Restituito'] != True) ]
-                
-                with st.container(border=True):
-                    c_nome, c_stato = st.columns([1, 2])
-                    with c_nome:
-                        st.markdown(f"### {strumento}")
-                        if prestito_attivo.empty: st.caption("🟢 DISPONIBILE")
-                        else: st.caption("🔴 IN PRESTITO")
-
-                    with c_stato:
-                        if not prestito_attivo.empty:
-                            record = prestito_attivo.iloc[0]
-                            scadenza = pd.to_datetime(record['Data_Scadenza']).date() if pd.notnull(record['Data_Scadenza']) else date.today()
-                            days_left = (scadenza - date.today()).days
-                            bg_color = "rgba(229, 62, 62, 0.2)" if days_left < 0 else "rgba(46, 204, 113, 0.2)"
-                            
-                            st.markdown(f"""<div style="background-color: {bg_color}; padding: 10px; border-radius: 8px;"><strong>Paziente:</strong> {record.get('Paziente', 'Unknown')}<br><strong>Scadenza:</strong> {scadenza.strftime('%d/%m')} ({days_left} gg)</div>""", unsafe_allow_html=True)
-                            
-                            if st.button("🔄 Restituisci", key=f"ret_{strumento}", use_container_width=True):
-                                with st.spinner("Restituzione in corso..."):
-                                    for _, row_to_close in prestito_attivo.iterrows():
-                                        update_generic("Prestiti", row_to_close['id'], {"Restituito": True})
-                                    st.toast(f"{strumento} restituito!"); time.sleep(1); st.rerun()
-                        else:
-                            c_paz, c_dur, c_btn = st.columns([2, 1, 1])
-                            with c_paz: paz_sel = st.selectbox("Paziente", nomi_paz, key=f"paz_{strumento}", label_visibility="collapsed")
-                            with c_dur:
-                                cols_d = st.columns(2)
-                                num = cols_d[0].number_input("Qta", 1, 52, 1, key=f"n_{strumento}", label_visibility="collapsed")
-                                unit = cols_d[1].selectbox("U", ["Sett", "Giorni"], key=f"u_{strumento}", label_visibility="collapsed")
-                            with c_btn:
-                                if st.button("➕ Presta", key=f"btn_{strumento}", type="primary", use_container_width=True):
-                                    if paz_sel != "-- Seleziona --":
-                                        delta = timedelta(weeks=num) if unit == "Sett" else timedelta(days=num)
-                                        if save_prestito_new(paz_sel, strumento, tab_name, date.today(), date.today() + delta):
-                                            st.toast("Prestito registrato!", icon="✅"); st.rerun()
-                                    else: st.toast("Seleziona prima un paziente!", icon="⚠️")
+            for strumento in INVENTARIO[tab_name]: card_strumento(strumento, tab_name)
     
     # TAB EXTRA (LOGICA DINAMICA)
     with tabs[3]:
         st.subheader("📦 Oggetti Extra")
-        df_inv_extra = get_data("Inventario")
-        extra_items = []
-        if not df_inv_extra.empty:
-             # Filtra quelli con Area = "Extra"
-             extra_items = df_inv_extra[df_inv_extra['Area'] == "Extra"]['Materiali'].tolist()
-        
         if not extra_items:
             st.info("Nessun oggetto extra in elenco. Aggiungine uno dal menu in alto.")
         else:
-            for strumento in extra_items:
-                prestito_attivo = pd.DataFrame()
-                if not df_pres.empty:
-                    prestito_attivo = df_pres[ (df_pres['Oggetto'] == strumento) & (df_pres['Restituito'] != True) ]
-                
-                with st.container(border=True):
-                    c_nome, c_stato = st.columns([1, 2])
-                    with c_nome:
-                        st.markdown(f"### {strumento}")
-                        if prestito_attivo.empty: st.caption("🟢 DISPONIBILE")
-                        else: st.caption("🔴 IN PRESTITO")
-
-                    with c_stato:
-                        if not prestito_attivo.empty:
-                            record = prestito_attivo.iloc[0]
-                            scadenza = pd.to_datetime(record['Data_Scadenza']).date() if pd.notnull(record['Data_Scadenza']) else date.today()
-                            days_left = (scadenza - date.today()).days
-                            bg_color = "rgba(229, 62, 62, 0.2)" if days_left < 0 else "rgba(46, 204, 113, 0.2)"
-                            
-                            st.markdown(f"""
-                            <div style="background-color: {bg_color}; padding: 10px; border-radius: 8px;">
-                                <strong>Paziente:</strong> {record.get('Paziente', 'Unknown')}<br>
-                                <strong>Scadenza:</strong> {scadenza.strftime('%d/%m')} ({days_left} gg)
-                            </div>
-                            """, unsafe_allow_html=True)
-                            
-                            if st.button("🔄 Restituisci", key=f"ret_{strumento}", use_container_width=True):
-                                with st.spinner("Restituzione..."):
-                                    for _, row_to_close in prestito_attivo.iterrows():
-                                        update_generic("Prestiti", row_to_close['id'], {"Restituito": True})
-                                    st.toast(f"{strumento} restituito!")
-                                    time.sleep(1)
-                                    st.rerun()
-                        else:
-                            c_paz, c_dur, c_btn = st.columns([2, 1, 1])
-                            with c_paz:
-                                paz_sel = st.selectbox("Paziente", nomi_paz, key=f"paz_{strumento}", label_visibility="collapsed")
-                            with c_dur:
-                                cols_d = st.columns(2)
-                                num = cols_d[0].number_input("Qta", 1, 52, 1, key=f"n_{strumento}", label_visibility="collapsed")
-                                unit = cols_d[1].selectbox("U", ["Sett", "Giorni"], key=f"u_{strumento}", label_visibility="collapsed")
-                            with c_btn:
-                                if st.button("➕ Presta", key=f"btn_{strumento}", type="primary", use_container_width=True):
-                                    if paz_sel != "-- Seleziona --":
-                                        delta = timedelta(weeks=num) if unit == "Sett" else timedelta(days=num)
-                                        if save_prestito_new(paz_sel, strumento, "Extra", date.today(), date.today() + delta):
-                                            st.toast("Prestito registrato!", icon="✅")
-                                            st.rerun()
-                                    else: st.toast("Seleziona paziente!", icon="⚠️")
+            for strumento in extra_items: card_strumento(strumento, "Extra")
+
+    # TAB CALENDARIO: occupazione e ricerca strumenti liberi
+    with tabs[4]:
+        cal = calendario_prestiti(store.version("Prestiti"), str(date.today()))
+        c_cat, c_per = st.columns([1, 2])
+        cat_sel = c_cat.selectbox("Categoria", ["-- Tutte --"] + list(INVENTARIO) + ["Extra"])
+        per_sel = c_per.date_input("Periodo", (date.today(), date.today() + timedelta(weeks=4)), format="DD/MM/YYYY", key="cal_periodo")
+        if len(per_sel) == 2:
+            oggetti_cat = [o for o in tutti_oggetti if cat_sel == "-- Tutte --" or CATEGORIA_OGGETTO[o] == cat_sel]
+            liberi = cal.disponibili(oggetti_cat, per_sel[0], per_sel[1])
+            st.caption(f"🟢 Liberi per tutto il periodo ({len(liberi)}/{len(oggetti_cat)}): " + (", ".join(liberi) if liberi else "nessuno"))
+            
+            occupazione = cal.tabella(oggetti_cat, per_sel[0], per_sel[1])
+            if occupazione.empty: st.info("Nessun prestito o prenotazione nel periodo.")
+            else:
+                chart = alt.Chart(occupazione).mark_bar(cornerRadius=4, height=16).encode(
+                    x=alt.X('Inizio:T', title=None, scale=alt.Scale(domain=[str(per_sel[0]), str(per_sel[1] + timedelta(days=1))]), axis=alt.Axis(labelColor="#cbd5e0", format="%d/%m")),
+                    x2='Fine:T',
+                    y=alt.Y('Oggetto', sort=oggetti_cat, title=None, axis=alt.Axis(labelColor="#cbd5e0", labelLimit=220)),
+                    color=alt.Color('Stato', scale=alt.Scale(domain=["In prestito", "Prenotato"], range=["#e53e3e", "#9f7aea"]), legend=alt.Legend(labelColor="#cbd5e0", title=None, orient="bottom")),
+                    tooltip=['Oggetto', 'Paziente', 'Stato', alt.Tooltip('Inizio:T', format="%d/%m/%Y"), alt.Tooltip('Fine:T', format="%d/%m/%Y")]
+                ).properties(height=max(200, 24 * len(oggetti_cat))).configure(background='transparent').configure_view(strokeWidth=0)
+                st.altair_chart(chart, use_container_width=True, theme=None)
+            
+            with st.expander("📋 Elenco prenotazioni future"):
+                futuri = occupazione[occupazione['Stato'] == "Prenotato"]
+                if futuri.empty: st.caption("Nessuna prenotazione nel periodo.")
+                for _, r in futuri.sort_values('Dal').iterrows():
+                    c_r, c_del = st.columns([5, 1])
+                    c_r.write(f"**{r['Oggetto']}** · {r['Paziente']} · {r['Dal'].strftime('%d/%m')} → {r['Al'].strftime('%d/%m')}")
+                    if c_del.button("🗑️", key=f"del_pren_{r['id']}"): delete_generic("Prestiti", r['id']); st.rerun()
 
 # =========================================================
 # SEZIONE 6: SCADENZE (PLANNING FINANZIARIO - VERSIONE PULSANTI & CARD)
@@ -1034,7 +1457,134 @@ elif menu == "🔄 Prestiti":
 elif menu == "📅 Scadenze":
     st.title("🗓️ Scadenziario Pagamenti")
     
+    CATEGORIE_SPESA = ["Affitto", "Utenze", "Tasse", "Assicurazioni", "Fornitori", "Personale", "Altro"]
+    
     # --- FORM DI INSERIMENTO ---
     with st.expander("➕ Aggiungi Nuova Scadenza / Spesa", expanded=False):
         with st.form("add_scadenza"):
-            c1, c2, c3 = st
+            c1, c2, c3 = st.columns([2, 1, 1])
+            desc = c1.text_input("Descrizione", placeholder="Es. Affitto studio")
+            importo = c2.number_input("Importo (€)", 0.0, 100000.0, 0.0, step=10.0)
+            categoria = c3.selectbox("Categoria", CATEGORIE_SPESA)
+            c4, c5, c6 = st.columns(3)
+            frequenza = c4.selectbox("Ricorrenza", FREQUENZE, index=2)
+            inizio = c5.date_input("Prima scadenza", date.today())
+            fine = c6.date_input("Ultima scadenza (opzionale)", value=None)
+            if st.form_submit_button("Salva Scadenza", use_container_width=True, type="primary"):
+                if desc and importo > 0:
+                    if save_scadenza(desc, importo, categoria, frequenza, inizio, fine): st.success("Salvato!"); st.rerun()
+                else: st.error("Inserisci descrizione e importo.")
+
+    df_reg = get_data("Scadenze")
+    if df_reg.empty:
+        st.info("Nessuna scadenza registrata.")
+    else:
+        for c in ['Descrizione', 'Categoria', 'Frequenza']:
+            if c not in df_reg.columns: df_reg[c] = ""
+        df_reg['Categoria'] = df_reg['Categoria'].fillna("Altro")
+        if 'Importo' not in df_reg.columns: df_reg['Importo'] = 0.0
+        df_reg['Importo'] = pd.to_numeric(df_reg['Importo'], errors='coerce').fillna(0.0)
+        for c in ['Data_Inizio', 'Data_Fine', 'Pagato_Fino']:
+            df_reg[c] = pd.to_datetime(df_reg[c], errors='coerce') if c in df_reg.columns else pd.NaT
+
+        oggi = pd.Timestamp.now().normalize()
+        c_oriz, c_freq = st.columns([3, 1])
+        mesi_oriz = c_oriz.slider("Orizzonte (mesi)", 1, 24, 3)
+        vista = c_freq.radio("Raggruppa per", ["Mese", "Settimana"], horizontal=True)
+        fine_oriz = oggi + pd.DateOffset(months=mesi_oriz)
+
+        # Un anno indietro basta per vedere gli arretrati non ancora pagati
+        occ = espandi_scadenze(df_reg, oggi - pd.DateOffset(years=1), fine_oriz)
+        arretrati = occ[(occ['Data'] < oggi) & (~occ['Pagato'].astype(bool))]
+        future = occ[occ['Data'] >= oggi]
+        prossimi_30 = future[future['Data'] <= oggi + pd.Timedelta(days=30)]
+
+        k1, k2, k3 = st.columns(3)
+        k1.metric("⚠️ Arretrati", f"{arretrati['Importo'].sum():.2f} €", f"{len(arretrati)} scadenze", delta_color="off")
+        k2.metric("📅 Prossimi 30 gg", f"{prossimi_30['Importo'].sum():.2f} €", f"{len(prossimi_30)} scadenze", delta_color="off")
+        k3.metric(f"📊 Prossimi {mesi_oriz} mesi", f"{future['Importo'].sum():.2f} €", f"{len(future)} scadenze", delta_color="off")
+
+        # GRAFICO FLUSSO DI CASSA
+        flusso = flusso_cassa(future, "MS" if vista == "Mese" else "W-MON")
+        if not flusso.empty:
+            df_flusso = flusso.rename("Totale").reset_index()
+            df_flusso['Periodo'] = df_flusso['Data'].dt.strftime('%m/%Y' if vista == "Mese" else '%d/%m')
+            chart = alt.Chart(df_flusso).mark_bar(cornerRadius=6, color="#9f7aea").encode(
+                x=alt.X('Periodo', sort=None, title=None, axis=alt.Axis(labelColor="#cbd5e0", labelAngle=0)),
+                y=alt.Y('Totale', title=None, axis=alt.Axis(labelColor="#cbd5e0")),
+                tooltip=['Periodo', alt.Tooltip('Totale', format='.2f')]
+            ).properties(height=280).configure(background='transparent').configure_view(strokeWidth=0).configure_axis(grid=False)
+            st.altair_chart(chart, use_container_width=True, theme=None)
+
+        # CARD: arretrati + prossime scadenze. "Pagato" compare solo sulla prima
+        # rata non pagata di ogni regola e sposta in avanti il suo Pagato_Fino.
+        st.subheader("🔔 Prossime Scadenze")
+        da_mostrare = pd.concat([arretrati, future[~future['Pagato'].astype(bool)]]).head(30)
+        if da_mostrare.empty: st.success("Nessuna scadenza in arrivo.")
+        prima_rata = set(da_mostrare.drop_duplicates('id').index)
+        for idx, row in da_mostrare.iterrows():
+            delta = (row['Data'] - oggi).days
+            color = "border-red" if delta < 0 else "border-yellow" if delta <= 7 else "border-green"
+            c_info, c_imp, c_btn = st.columns([4, 1, 1], gap="small")
+            with c_info: st.markdown(f"""<div class="alert-row-name {color}">{row['Data'].strftime('%d/%m/%Y')} · {row['Descrizione']} <span style="color:#a0aec0; margin-left:8px;">({row['Categoria']})</span></div>""", unsafe_allow_html=True)
+            with c_imp: st.markdown(f"**{row['Importo']:.2f} €**")
+            with c_btn:
+                if idx in prima_rata and st.button("✅ Pagato", key=f"pag_{row['id']}_{row['Data']:%Y%m%d}", use_container_width=True):
+                    update_generic("Scadenze", row['id'], {"Pagato_Fino": row['Data']}); st.rerun()
+
+        with st.expander("⚙️ Gestisci Regole"):
+            for _, r in df_reg.sort_values('Descrizione').iterrows():
+                c_r, c_del = st.columns([5, 1])
+                fine_str = r['Data_Fine'].strftime('%d/%m/%Y') if pd.notna(r['Data_Fine']) else "—"
+                inizio_str = r['Data_Inizio'].strftime('%d/%m/%Y') if pd.notna(r['Data_Inizio']) else "N.D."
+                c_r.write(f"**{r['Descrizione']}** · {r['Importo']:.2f} € · {r['Frequenza']} dal {inizio_str} al {fine_str}")
+                if c_del.button("🗑️", key=f"del_scad_{r['id']}"): delete_generic("Scadenze", r['id']); st.rerun()
+
+# =========================================================
+# SEZIONE 7: ARCHIVIO STORICO
+# =========================================================
+elif menu == "🗄️ Archivio":
+    st.title("🗄️ Archivio Storico")
+    st.caption("Record tolti da Airtable dal job di archiviazione (python cli.py archive): restano consultabili qui, letti dai file Parquet locali mese per mese.")
+    c_tab, c_da, c_a = st.columns([2, 1, 1])
+    tab_arch = c_tab.selectbox("Tabella", list(archivio.REGOLE), key="arch_tabella")
+    mesi_arch = archivio.mesi(tab_arch)
+    if not mesi_arch: st.info("Nessun record archiviato per questa tabella.")
+    else:
+        mese_da = c_da.selectbox("Dal mese", mesi_arch[::-1], key="arch_da")
+        mese_a = c_a.selectbox("Al mese", mesi_arch, key="arch_a")
+        cerca = st.text_input("🔍 Cerca paziente", key="arch_cerca")
+        # Solo le partizioni dei mesi scelti, solo le basi della vista corrente
+        df_arch = archivio.leggi(tab_arch, mese_da, mese_a, basi=[s.base_id for s in store.stores.values()])
+        if cerca and not df_arch.empty and 'Paziente' in df_arch.columns:
+            df_arch = df_arch[df_arch['Paziente'].fillna("").str.contains(cerca, case=False, regex=False)]
+        st.caption(f"{len(df_arch)} record · mesi {mese_da} → {mese_a}")
+        if not df_arch.empty:
+            st.dataframe(df_arch.drop(columns=[c for c in ['Record_JSON', 'Base', CAMPO_LINK] if c in df_arch.columns]), hide_index=True, use_container_width=True)
+
+# =========================================================
+# BADGE FRESCHEZZA DATI (SIDEBAR)
+# =========================================================
+mostra_badge_dati(badge_dati)
+
+# =========================================================
+# PROFILO DEL RERUN (solo se attivo)
+# =========================================================
+if profilo is not None:
+    segna(menu)
+    profilo.chiudi()
+    st.session_state.pop("_profilo_aperto", None)
+    registro_profili().registra(profilo)
+    # Disegnato dopo la chiusura: non entra nei conteggi del rerun
+    with st.sidebar.expander("⏱️ Profilo rerun", expanded=True):
+        r = profilo.riepilogo()
+        p1, p2 = st.columns(2)
+        p1.metric("Tempo", f"{r['ms']} ms")
+        if r['messaggi']:
+            p2.metric("Payload", f"{r['KB']} KB")
+            p1.metric("Widget", r['widget']); p2.metric("Elementi", r['elementi'])
+        else: st.caption("⚠️ Conteggio messaggi non disponibile con questa versione di Streamlit: solo tempi e cProfile.")
+        st.caption(r['tratti'])
+        st.caption("Più usati: " + ", ".join(f"{k} {v}" for k, v in sorted(profilo.per_tipo.items(), key=lambda x: -x[1])[:6]))
+        st.dataframe(pd.DataFrame(list(registro_profili().storico)[::-1]), hide_index=True, height=200)
+        st.caption(f"File .prof dei rerun più lenti in {PROFILI_DIR} (snakeviz / flameprof)")
@@ -0,0 +1,96 @@
+# =========================================================
+# ARCHIVIO STORICO (PARQUET LOCALE)
+# =========================================================
+# Prestiti restituiti, Consegne completate e Preventivi vecchi escono dalle
+# tabelle Airtable "calde" e finiscono in file Parquet compressi, uno per mese:
+#   dati_locali/archivio/<Tabella>/<AAAA-MM>.parquet
+# Prima si scrive il file (atomico), poi si cancella da Airtable a blocchi di
+# 10: se qualcosa va storto un record può restare in entrambi, mai in nessuno.
+import glob
+import json
+import os
+
+import pandas as pd
+
+from datastore import BATCH_AIRTABLE, DATA_DIR
+
+ARCHIVIO_DIR = os.path.join(DATA_DIR, "archivio")
+COMPRESSIONE = "zstd"
+
+# Tabella -> (campo data che decide l'età, condizione per archiviare)
+REGOLE = {
+    "Prestiti": ("Data_Scadenza", lambda f: bool(f.get('Restituito'))),
+    "Consegne": ("Data_Scadenza", lambda f: bool(f.get('Completato'))),
+    "Preventivi_Salvati": ("Data_Creazione", lambda f: True),
+}
+# Età minima (giorni) oltre la quale un record viene archiviato
+GIORNI_ARCHIVIO = {"Prestiti": 365, "Consegne": 365, "Preventivi_Salvati": 365}
+
+
+def candidati(nome, records, giorni=None, oggi=None):
+    # [(id, fields, "AAAA-MM")] dei record archiviabili (senza data: mai)
+    campo, condizione = REGOLE[nome]
+    giorni = GIORNI_ARCHIVIO[nome] if giorni is None else giorni
+    limite = pd.Timestamp(oggi or pd.Timestamp.now()).normalize() - pd.Timedelta(days=giorni)
+    scelti = []
+    for rid, f in records.items():
+        data = pd.to_datetime(f.get(campo), errors='coerce')
+        if pd.isna(data) or data >= limite or not condizione(f): continue
+        scelti.append((rid, f, data.strftime('%Y-%m')))
+    return scelti
+
+
+def _tabella(righe, base_id):
+    # Colonne piatte per le ricerche (liste e oggetti come testo) + il record
+    # originale in JSON, per poterlo eventualmente ricaricare su Airtable
+    df = pd.DataFrame([{**f, 'id': rid} for rid, f, _ in righe])
+    df = df.apply(lambda col: col.map(lambda v: ", ".join(map(str, v)) if isinstance(v, list) else (json.dumps(v, ensure_ascii=False) if isinstance(v, dict) else v)))
+    df['Base'] = base_id
+    df['Record_JSON'] = [json.dumps(f, ensure_ascii=False) for _, f, _ in righe]
+    df['Archiviato_Il'] = pd.Timestamp.now().isoformat(timespec="seconds")
+    return df
+
+
+def _scrivi_mese(nome, mese, df):
+    # Unisce al file del mese già esistente (un id compare una volta sola)
+    cartella = os.path.join(ARCHIVIO_DIR, nome)
+    os.makedirs(cartella, exist_ok=True)
+    path = os.path.join(cartella, f"{mese}.parquet")
+    if os.path.exists(path):
+        df = pd.concat([pd.read_parquet(path), df], ignore_index=True).drop_duplicates('id', keep='last')
+    # Colonne testuali come stringhe: tipi misti da Airtable non rompono lo schema
+    for c in df.columns:
+        if df[c].dtype == object: df[c] = df[c].astype("string")
+    tmp = path + ".tmp"
+    df.to_parquet(tmp, index=False, compression=COMPRESSIONE)
+    os.replace(tmp, path)
+
+
+def archivia(store, nome, giorni=None, oggi=None, prova=False):
+    # Sposta nell'archivio i record vecchi di "nome"; ritorna quanti (con prova=True conta soltanto)
+    scelti = candidati(nome, store.records(nome), giorni, oggi)
+    if prova or not scelti: return len(scelti)
+    per_mese = {}
+    for riga in scelti: per_mese.setdefault(riga[2], []).append(riga)
+    for mese, righe in sorted(per_mese.items()):
+        _scrivi_mese(nome, mese, _tabella(righe, store.base_id))
+    ids = [rid for rid, _, _ in scelti]
+    for i in range(0, len(ids), BATCH_AIRTABLE):
+        blocco = ids[i:i + BATCH_AIRTABLE]
+        store.table(nome).batch_delete(blocco)
+        for rid in blocco: store.remove(nome, rid)
+    return len(ids)
+
+
+def mesi(nome):
+    # Partizioni presenti, dalla più recente
+    return sorted((os.path.basename(p)[:-len(".parquet")] for p in glob.glob(os.path.join(ARCHIVIO_DIR, nome, "*.parquet"))), reverse=True)
+
+
+def leggi(nome, da=None, a=None, basi=None):
+    # Legge solo i mesi nell'intervallo ["AAAA-MM", "AAAA-MM"]; basi = filtro per base
+    scelti = [m for m in mesi(nome) if (da is None or m >= da) and (a is None or m <= a)]
+    if not scelti: return pd.DataFrame()
+    df = pd.concat([pd.read_parquet(os.path.join(ARCHIVIO_DIR, nome, f"{m}.parquet")) for m in scelti], ignore_index=True)
+    if basi is not None and 'Base' in df.columns: df = df[df['Base'].isin(list(basi))]
+    return df
@@ -0,0 +1,208 @@
+# =========================================================
+# JOB DA RIGA DI COMANDO (CRON / MANUTENZIONE NOTTURNA)
+# =========================================================
+# Stessa logica della Dashboard, senza browser né sessione Streamlit.
+#
+#   python cli.py sync [--full] [--tabelle Prestiti Consegne ...]
+#   python cli.py digest [--out digest.md] [--offline]
+#   python cli.py export [--out snapshot.xlsx] [--offline]
+#   python cli.py rollup [--offline]
+#   python cli.py archive [--giorni 365] [--tabelle Prestiti ...] [--prova]
+#
+# Credenziali: variabili AIRTABLE_TOKEN / AIRTABLE_BASE_ID oppure
+# .streamlit/secrets.toml (le stesse chiavi usate dall'app). Con più sedi
+# ([AIRTABLE_BASES] nei secrets) ogni comando lavora su tutte le basi, ognuna
+# con il suo TableStore; digest, export e rollup le leggono unite.
+#
+# Esempio crontab:
+#   30 6 * * *  cd /srv/fisio && python cli.py sync && python cli.py digest && python cli.py rollup --offline
+#   0 3 * * 0   cd /srv/fisio && python cli.py sync --full && python cli.py export --offline
+#   0 4 1 * *   cd /srv/fisio && python cli.py archive
+import argparse
+import os
+import sys
+from datetime import date, datetime
+
+import pandas as pd
+from pyairtable import Api
+
+import archivio
+import logica
+import rollup
+from datastore import DATA_DIR, TableStore, cartella_snapshot
+from movimenti import Consumi, percorso_db
+from sedi import StoreSedi
+
+TABELLE = ["Pazienti", "Prestiti", "Consegne", "Preventivi_Salvati", "Inventario", "Servizi", "Preventivi_Standard", "Scadenze"]
+
+
+def credenziali():
+    # (token, {sede: base_id})
+    token, base = os.environ.get("AIRTABLE_TOKEN"), os.environ.get("AIRTABLE_BASE_ID")
+    if token and base: return token, {"Principale": base}
+    basi = {}
+    path = os.path.join(".streamlit", "secrets.toml")
+    if os.path.exists(path):
+        import tomllib
+        with open(path, "rb") as f: secrets = tomllib.load(f)
+        token, base = token or secrets.get("AIRTABLE_TOKEN"), base or secrets.get("AIRTABLE_BASE_ID")
+        basi = dict(secrets.get("AIRTABLE_BASES") or {})
+    if not basi and base: basi = {"Principale": base}
+    if not token or not basi:
+        sys.exit("Credenziali mancanti: imposta AIRTABLE_TOKEN e AIRTABLE_BASE_ID (o .streamlit/secrets.toml, anche con [AIRTABLE_BASES]).")
+    return token, basi
+
+
+def apri_sedi():
+    token, basi = credenziali()
+    api = Api(token)
+    stores = {}
+    for sede, base_id in basi.items():
+        stores[sede] = TableStore(api, base_id)
+        stores[sede].carica_snapshot(cartella_snapshot(base_id))
+    return StoreSedi(stores)
+
+
+def salva_snapshot(sedi, tabelle=None):
+    for s in sedi.stores.values(): s.salva_snapshot(cartella_snapshot(s.base_id), tabelle)
+
+
+def per_sede(sedi):
+    # [(prefisso per i messaggi, store)]: con una sola base niente prefisso
+    return [(f"[{sede}] " if sedi.multipla else "", s) for sede, s in sedi.stores.items()]
+
+
+def sincronizza(sedi, tabelle, completa=False):
+    for prefisso, store in per_sede(sedi):
+        for nome in tabelle:
+            try:
+                if completa:
+                    store.refresh(nome)
+                    print(f"{prefisso}{nome}: {len(store.records(nome))} record (completo)")
+                else:
+                    n = store.refresh_incrementale(nome)
+                    print(f"{prefisso}{nome}: {n} record nuovi o modificati")
+            except Exception as e:
+                print(f"{prefisso}{nome}: ERRORE {e}", file=sys.stderr)
+    salva_snapshot(sedi, tabelle)
+
+
+def leggi(sedi, nome, offline):
+    # Online: prima un sync incrementale di ogni base. Offline: solo gli
+    # snapshot su disco, anche se vecchi (le basi senza snapshot restano fuori)
+    if offline:
+        caricate = {sede: s for sede, s in sedi.stores.items() if s.age(nome) is not None}
+        if not caricate: return pd.DataFrame()
+        sedi = StoreSedi(caricate)
+    else:
+        for s in sedi.stores.values(): s.refresh_incrementale(nome)
+    return sedi.get(nome, max_age=float("inf"))
+
+
+def componi_digest(sedi, offline):
+    oggi = logica.oggi_ts()
+    paz = logica.prepara_pazienti(leggi(sedi, "Pazienti", offline))
+    pres = logica.prepara_prestiti(leggi(sedi, "Prestiti", offline))
+    prev = logica.prepara_preventivi(leggi(sedi, "Preventivi_Salvati", offline))
+    inv = logica.prepara_inventario(leggi(sedi, "Inventario", offline))
+    cons = logica.classifica_consegne(logica.prepara_consegne(leggi(sedi, "Consegne", offline)), oggi)
+    # Consumi: un database per base, gli id articolo non si ripetono fra le basi
+    tassi = {}
+    for s in sedi.stores.values(): tassi.update(Consumi(percorso_db(s.base_id)).tassi())
+
+    def data(v):
+        return v.strftime('%d/%m/%Y') if pd.notna(v) else "N.D."
+
+    sezioni = []
+    if not paz.empty:
+        sezioni.append(("📞 Recall necessari", [f"{r['Cognome']} {r['Nome']} (disdetto il {data(r['Data_Disdetta'])})" for _, r in logica.da_richiamare(paz, oggi).iterrows()]))
+        sezioni.append(("🛑 Reinserimento post-visita", [f"{r['Cognome']} {r['Nome']} (visitato il {data(r['Data_Visita'])})" for _, r in logica.visite_da_reinserire(paz, oggi).iterrows()]))
+    if not cons.empty:
+        sezioni.append(("📨 Consegne scadute", [f"{r['Paziente']}: {r['Indicazione']} [{r['Area']}] (scaduta il {data(r['Data_Scadenza'])})" for _, r in cons[cons['Stato'] == "scaduto"].iterrows()]))
+    sezioni.append(("⚠️ Prestiti scaduti", [f"{r['Oggetto']} - {r['Paziente']} (scaduto il {data(r['Data_Scadenza'])})" for _, r in logica.prestiti_scaduti(pres, oggi).iterrows()]))
+    sezioni.append((f"⏳ Preventivi > {logica.GIORNI_PREVENTIVO} gg", [f"{r['Paziente']} ({data(r['Data_Creazione'])}, {r['Totale']}€)" for _, r in logica.preventivi_scaduti(prev, oggi).iterrows()]))
+    sezioni.append(("📦 Prodotti in esaurimento", [f"{r['Materiali']} (Qta {r['Quantita']:.0f}, soglia {r['Soglia_Minima']:.0f}, ordinarne {r['Da_Ordinare']})" for _, r in logica.scorte_in_esaurimento(inv, tassi).iterrows()]))
+
+    righe = [f"# Avvisi del {oggi.strftime('%d/%m/%Y')}", ""]
+    for titolo, voci in sezioni:
+        righe.append(f"## {titolo}: {len(voci)}")
+        righe.extend(f"- {v}" for v in voci)
+        righe.append("")
+    return "\n".join(righe)
+
+
+def esporta(sedi, tabelle, out, offline):
+    # Un foglio per tabella; liste e allegati diventano testo
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    with pd.ExcelWriter(out) as xls:
+        for nome in tabelle:
+            df = leggi(sedi, nome, offline)
+            if df.empty: continue
+            df = df.apply(lambda col: col.map(lambda v: ", ".join(map(str, v)) if isinstance(v, list) else (str(v) if isinstance(v, dict) else v)))
+            df.to_excel(xls, sheet_name=nome[:31], index=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Job batch del Gestionale Fisio Pro")
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p = sub.add_parser("sync", help="Scarica le tabelle e aggiorna gli snapshot locali")
+    p.add_argument("--full", action="store_true", help="Download completo (rileva anche i record cancellati)")
+    p.add_argument("--tabelle", nargs="+", default=TABELLE)
+
+    p = sub.add_parser("digest", help="Scrive il riepilogo giornaliero degli avvisi")
+    p.add_argument("--out", default=None, help="File di destinazione (default: dati_locali/digest/digest_AAAA-MM-GG.md, '-' = stdout)")
+    p.add_argument("--offline", action="store_true", help="Usa solo gli snapshot su disco")
+
+    p = sub.add_parser("export", help="Esporta gli snapshot in un file Excel")
+    p.add_argument("--out", default=None, help="Default: dati_locali/export/snapshot_AAAAMMGG_HHMM.xlsx")
+    p.add_argument("--tabelle", nargs="+", default=TABELLE)
+    p.add_argument("--offline", action="store_true")
+
+    p = sub.add_parser("rollup", help="Aggiorna i rollup giornalieri delle aree")
+    p.add_argument("--offline", action="store_true")
+
+    p = sub.add_parser("archive", help="Sposta i record vecchi in Parquet locale e li cancella da Airtable")
+    p.add_argument("--giorni", type=int, default=None, help="Età minima in giorni (default per tabella: archivio.GIORNI_ARCHIVIO)")
+    p.add_argument("--tabelle", nargs="+", default=list(archivio.REGOLE), choices=list(archivio.REGOLE))
+    p.add_argument("--prova", action="store_true", help="Conta soltanto, senza scrivere né cancellare")
+
+    args = parser.parse_args(argv)
+    sedi = apri_sedi()
+
+    if args.comando == "sync":
+        sincronizza(sedi, args.tabelle, completa=args.full)
+    elif args.comando == "digest":
+        testo = componi_digest(sedi, args.offline)
+        if args.out == "-": print(testo)
+        else:
+            out = args.out or os.path.join(DATA_DIR, "digest", f"digest_{date.today()}.md")
+            os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+            with open(out, "w", encoding="utf-8") as f: f.write(testo)
+            print(f"Digest scritto in {out}")
+    elif args.comando == "export":
+        out = args.out or os.path.join(DATA_DIR, "export", f"snapshot_{datetime.now():%Y%m%d_%H%M}.xlsx")
+        esporta(sedi, args.tabelle, out, args.offline)
+        print(f"Snapshot esportato in {out}")
+    elif args.comando == "rollup":
+        n = rollup.aggiorna(leggi(sedi, "Pazienti", args.offline), leggi(sedi, "Prestiti", args.offline), leggi(sedi, "Preventivi_Salvati", args.offline))
+        print(f"Rollup: {n} giorni elaborati")
+    elif args.comando == "archive":
+        # Ogni base con il suo store: le cancellazioni vanno alla base che possiede il record
+        for prefisso, store in per_sede(sedi):
+            for nome in args.tabelle:
+                try:
+                    # Download completo: si decide sui dati attuali, non su uno snapshot vecchio
+                    store.refresh(nome)
+                    n = archivio.archivia(store, nome, args.giorni, prova=args.prova)
+                    print(f"{prefisso}{nome}: {n} record {'archiviabili' if args.prova else 'archiviati'}")
+                except Exception as e:
+                    print(f"{prefisso}{nome}: ERRORE {e}", file=sys.stderr)
+        if not args.prova: salva_snapshot(sedi, args.tabelle)
+
+    if not getattr(args, "offline", True):
+        salva_snapshot(sedi)
+
+
+if __name__ == "__main__":
+    main()
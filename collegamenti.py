@@ -0,0 +1,80 @@
+# =========================================================
+# COLLEGAMENTO PAZIENTI <-> PRESTITI / CONSEGNE / PREVENTIVI
+# =========================================================
+# Le tabelle collegate salvano, oltre al vecchio testo "Cognome Nome", un campo
+# link di Airtable (lista di record id) verso Pazienti. Gli indici per paziente
+# vengono costruiti una volta per sincronizzazione: la scheda paziente li legge
+# con lookup diretti, senza confronti di stringhe sulle tabelle intere.
+from datastore import BATCH_AIRTABLE
+
+CAMPO_LINK = "Paziente_Link"
+TABELLE_COLLEGATE = ["Prestiti", "Consegne", "Preventivi_Salvati"]
+
+
+def nome_paziente(fields):
+    return f"{fields.get('Cognome', '')} {fields.get('Nome', '')}".strip()
+
+
+def mappa_nomi(records_paz):
+    # "Cognome Nome" (normalizzato) -> [id]; più id = omonimi
+    mappa = {}
+    for pid, f in records_paz.items():
+        mappa.setdefault(nome_paziente(f).casefold(), []).append(pid)
+    return mappa
+
+
+def link_di(fields):
+    link = fields.get(CAMPO_LINK)
+    if isinstance(link, list) and link: return link[0]
+    if isinstance(link, str) and link: return link
+    return None
+
+
+def risolvi(fields, mappa):
+    # id del paziente: prima il link, poi (record non ancora migrati) il nome se univoco
+    pid = link_di(fields)
+    if pid: return pid
+    nome = fields.get('Paziente')
+    if not isinstance(nome, str): return None
+    ids = mappa.get(nome.strip().casefold(), [])
+    return ids[0] if len(ids) == 1 else None
+
+
+class IndicePazienti:
+    def __init__(self, records_paz, records_per_tabella):
+        mappa = mappa_nomi(records_paz)
+        self.pazienti = records_paz
+        self.per_tabella = {}
+        for tabella, records in records_per_tabella.items():
+            indice = {}
+            for rid, f in records.items():
+                pid = risolvi(f, mappa)
+                if pid: indice.setdefault(pid, []).append(rid)
+            self.per_tabella[tabella] = indice
+
+    def record_ids(self, tabella, pid):
+        return self.per_tabella.get(tabella, {}).get(pid, [])
+
+
+def piano_migrazione(records_tab, records_paz):
+    # Record senza link: (aggiornamenti batch, nomi non risolti o ambigui)
+    mappa = mappa_nomi(records_paz)
+    aggiornamenti, irrisolti = [], []
+    for rid, f in records_tab.items():
+        if link_di(f): continue
+        nome = f.get('Paziente')
+        ids = mappa.get(nome.strip().casefold(), []) if isinstance(nome, str) else []
+        if len(ids) == 1: aggiornamenti.append({"id": rid, "fields": {CAMPO_LINK: [ids[0]]}})
+        else: irrisolti.append((rid, nome, len(ids)))
+    return aggiornamenti, irrisolti
+
+
+def migra(store, tabella, records_paz):
+    # Scrive i link a blocchi di 10 (limite batch di Airtable) passando dal
+    # rate limiter dello store; ritorna (collegati, irrisolti)
+    aggiornamenti, irrisolti = piano_migrazione(store.records(tabella), records_paz)
+    for i in range(0, len(aggiornamenti), BATCH_AIRTABLE):
+        blocco = aggiornamenti[i:i + BATCH_AIRTABLE]
+        for rec in store.table(tabella).batch_update(blocco):
+            store.upsert(tabella, rec)
+    return len(aggiornamenti), irrisolti
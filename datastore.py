@@ -0,0 +1,322 @@
+# =========================================================
+# STORE CONDIVISO DELLE TABELLE AIRTABLE
+# =========================================================
+# Vive in un modulo separato (e non in app.py) perché app.py viene rieseguito
+# a ogni rerun: le classi qui sotto restano le stesse per tutta la vita del
+# processo e un'unica istanza viene condivisa da tutte le sessioni del browser.
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# Cartella locale per snapshot, rollup ed esportazioni (fuori da git)
+DATA_DIR = os.environ.get("FISIO_DATA_DIR", "dati_locali")
+SNAPSHOT_DIR = os.path.join(DATA_DIR, "snapshot")
+# Massimo record per richiesta batch di Airtable (create, update, delete)
+BATCH_AIRTABLE = 10
+
+
+def cartella_snapshot(base_id):
+    # Una cartella per base: con più sedi i file delle tabelle non si sovrascrivono
+    return os.path.join(SNAPSHOT_DIR, base_id)
+
+
+class RateLimiter:
+    # Airtable accetta max 5 richieste/secondo per base: distanziamo le chiamate
+    # di tutte le sessioni (letture e scritture) con un unico "rubinetto".
+    def __init__(self, rps=4):
+        self.intervallo = 1.0 / rps
+        self._lock = threading.Lock()
+        self._prossimo = 0.0
+
+    def wait(self):
+        with self._lock:
+            ora = time.monotonic()
+            attesa = self._prossimo - ora
+            self._prossimo = max(ora, self._prossimo) + self.intervallo
+        if attesa > 0: time.sleep(attesa)
+
+
+class CircuitoAperto(Exception):
+    pass
+
+
+class CircuitBreaker:
+    # Dopo "soglia" errori di fila smette di chiamare Airtable per "pausa"
+    # secondi (raddoppiata a ogni nuovo errore, fino a pausa_max); poi lascia
+    # passare un tentativo di prova.
+    def __init__(self, soglia=3, pausa=30, pausa_max=600):
+        self.soglia = soglia
+        self.pausa = pausa
+        self.pausa_max = pausa_max
+        self.errori = 0
+        self.aperto_fino = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def aperto(self):
+        return time.monotonic() < self.aperto_fino
+
+    def successo(self):
+        with self._lock:
+            self.errori = 0
+            self.aperto_fino = 0.0
+
+    def fallimento(self):
+        with self._lock:
+            self.errori += 1
+            if self.errori >= self.soglia:
+                self.aperto_fino = time.monotonic() + min(self.pausa * 2 ** (self.errori - self.soglia), self.pausa_max)
+
+
+class _Tabella:
+    __slots__ = ("records", "versione", "aggiornato", "errore", "_df")
+
+    def __init__(self):
+        self.records = {}       # id -> fields
+        self.versione = 0
+        self.aggiornato = None  # time.time() dell'ultimo download completo
+        self.errore = None      # messaggio dell'ultimo download fallito (None se ok)
+        self._df = None
+
+    def df(self):
+        if self._df is None:
+            self._df = pd.DataFrame([{'id': rid, **f} for rid, f in self.records.items()]) if self.records else pd.DataFrame()
+        return self._df
+
+
+class TableStore:
+    # Snapshot per tabella + contatore di versione. Ogni tabella viene scaricata
+    # una sola volta per processo (anche con N sessioni aperte) e poi aggiornata
+    # in memoria dalle scritture di qualunque sessione.
+    def __init__(self, api, base_id, ttl=300, rps=4):
+        self.api = api
+        self.base_id = base_id
+        self.ttl = ttl
+        self.limiter = RateLimiter(rps)
+        self.breaker = CircuitBreaker()
+        self._lock = threading.RLock()
+        self._tabelle = {}
+        self._fetch_locks = {}
+        self._in_corso = set()
+        self.refresher = None
+
+    def _tab(self, nome):
+        with self._lock:
+            if nome not in self._tabelle:
+                self._tabelle[nome] = _Tabella()
+                self._fetch_locks[nome] = threading.RLock()
+            return self._tabelle[nome]
+
+    def table(self, nome):
+        # Accesso diretto all'API (per le scritture), già "in coda" col rate limit
+        self.limiter.wait()
+        return self.api.table(self.base_id, nome)
+
+    def _scarica(self, nome, **kwargs):
+        tab = self._tab(nome)
+        if self.breaker.aperto:
+            raise CircuitoAperto(f"Airtable in pausa dopo {self.breaker.errori} errori consecutivi")
+        try:
+            records = self.table(nome).all(**kwargs)
+        except Exception as e:
+            self.breaker.fallimento()
+            tab.errore = str(e)
+            raise
+        self.breaker.successo()
+        return records
+
+    def refresh(self, nome):
+        tab = self._tab(nome)
+        with self._fetch_locks[nome]:
+            records = self._scarica(nome)
+            with self._lock:
+                tab.records = {r['id']: r['fields'] for r in records}
+                tab.aggiornato = time.time()
+                tab.errore = None
+                tab.versione += 1
+                tab._df = None
+
+    def refresh_incrementale(self, nome):
+        # Scarica solo i record modificati dopo l'ultimo snapshot (con un minuto
+        # di margine). Le cancellazioni non si vedono: serve ogni tanto un
+        # refresh completo. Ritorna il numero di record ricevuti.
+        tab = self._tab(nome)
+        if tab.aggiornato is None:
+            self.refresh(nome)
+            return len(tab.records)
+        with self._fetch_locks[nome]:
+            inizio = time.time()
+            dal = datetime.fromtimestamp(tab.aggiornato - 60, timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+            records = self._scarica(nome, formula=f"IS_AFTER(LAST_MODIFIED_TIME(), '{dal}')")
+            with self._lock:
+                for r in records: tab.records[r['id']] = r['fields']
+                tab.aggiornato = inizio
+                tab.errore = None
+                if records:
+                    tab.versione += 1
+                    tab._df = None
+            return len(records)
+
+    def _refresh_in_background(self, nome):
+        # Stale-while-revalidate: chi legge riceve subito l'ultimo snapshot buono,
+        # il nuovo download parte in un thread (uno solo per tabella).
+        with self._lock:
+            if nome in self._in_corso: return
+            self._in_corso.add(nome)
+
+        def job():
+            try: self.refresh(nome)
+            except Exception: pass
+            finally:
+                with self._lock: self._in_corso.discard(nome)
+        threading.Thread(target=job, name=f"refresh-{nome}", daemon=True).start()
+
+    def assicura(self, nome, max_age=None):
+        # Solleva un'eccezione solo se la tabella non è MAI stata scaricata:
+        # altrimenti tiene l'ultimo snapshot buono, anche se vecchio. Non
+        # costruisce il DataFrame: basta per chi legge con records()/record().
+        tab = self._tab(nome)
+        if tab.aggiornato is None:
+            # Un solo download alla volta per tabella: le altre sessioni aspettano
+            # e poi trovano lo snapshot già pronto.
+            with self._fetch_locks[nome]:
+                if tab.aggiornato is None: self.refresh(nome)
+        else:
+            # Le tabelle tenute calde dal refresher non vengono mai riscaricate qui
+            gestita = self.refresher is not None and self.refresher.is_alive() and nome in self.refresher.schedule
+            if max_age is None: max_age = float("inf") if gestita else self.ttl
+            if time.time() - tab.aggiornato > max_age: self._refresh_in_background(nome)
+
+    def get(self, nome, max_age=None):
+        self.assicura(nome, max_age)
+        tab = self._tab(nome)
+        with self._lock:
+            return tab.df().copy()
+
+    def record(self, nome, rid):
+        with self._lock:
+            return self._tab(nome).records.get(rid)
+
+    def records(self, nome):
+        # Copia superficiale {id: fields}: letture puntuali senza costruire il DataFrame
+        with self._lock:
+            return dict(self._tab(nome).records)
+
+    def contiene(self, rid):
+        # True se il record è in una qualunque tabella già letta di questa base
+        with self._lock:
+            return any(rid in t.records for t in self._tabelle.values())
+
+    def age(self, nome):
+        tab = self._tab(nome)
+        return None if tab.aggiornato is None else time.time() - tab.aggiornato
+
+    def stato(self, nome):
+        # (timestamp ultimo snapshot buono, True se i dati potrebbero essere vecchi)
+        tab = self._tab(nome)
+        return tab.aggiornato, tab.errore is not None or self.breaker.aperto
+
+    def version(self, nome):
+        return self._tab(nome).versione
+
+    def upsert(self, nome, record):
+        # record = dict restituito da pyairtable dopo create/update
+        tab = self._tab(nome)
+        with self._lock:
+            tab.records[record['id']] = record.get('fields', {})
+            tab.versione += 1
+            tab._df = None
+
+    def remove(self, nome, rid):
+        tab = self._tab(nome)
+        with self._lock:
+            if tab.records.pop(rid, None) is not None:
+                tab.versione += 1
+                tab._df = None
+
+    def invalidate(self, nome=None):
+        with self._lock:
+            for n, tab in self._tabelle.items():
+                if nome is None or n == nome: tab.aggiornato = None
+
+    # --- SNAPSHOT SU DISCO ---
+    # Scritti dai job notturni (cli.py) e letti all'avvio dell'app, così il
+    # primo utente non aspetta il download completo di ogni tabella.
+    def salva_snapshot(self, cartella, nomi=None):
+        os.makedirs(cartella, exist_ok=True)
+        with self._lock:
+            dati = {n: (t.aggiornato, dict(t.records)) for n, t in self._tabelle.items()
+                    if t.aggiornato is not None and (nomi is None or n in nomi)}
+        for nome, (aggiornato, records) in dati.items():
+            tmp = os.path.join(cartella, f"{nome}.json.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"base_id": self.base_id, "aggiornato": aggiornato, "records": records}, f, ensure_ascii=False)
+            os.replace(tmp, os.path.join(cartella, f"{nome}.json"))
+        return list(dati)
+
+    def carica_snapshot(self, cartella):
+        caricate = []
+        if not os.path.isdir(cartella): return caricate
+        for file in os.listdir(cartella):
+            if not file.endswith(".json"): continue
+            try:
+                with open(os.path.join(cartella, file), encoding="utf-8") as f: dati = json.load(f)
+            except (OSError, ValueError): continue
+            if dati.get("base_id") != self.base_id: continue
+            nome = file[:-len(".json")]
+            tab = self._tab(nome)
+            with self._lock:
+                if tab.aggiornato is not None and tab.aggiornato >= dati["aggiornato"]: continue
+                tab.records = dati["records"]
+                tab.aggiornato = dati["aggiornato"]
+                tab.versione += 1
+                tab._df = None
+            caricate.append(nome)
+        return caricate
+
+    def start_refresher(self, schedule):
+        if self.refresher is None or not self.refresher.is_alive():
+            self.refresher = Refresher(self, schedule)
+            self.refresher.start()
+        return self.refresher
+
+
+class Refresher(threading.Thread):
+    # Thread del processo server che riscarica ogni tabella secondo il suo
+    # intervallo (secondi). Passa dallo stesso rate limiter delle pagine e in
+    # caso di errore raddoppia l'attesa fino a backoff_max.
+    def __init__(self, store, schedule, backoff_max=900):
+        super().__init__(name="airtable-refresher", daemon=True)
+        self.store = store
+        self.schedule = dict(schedule)
+        self.backoff_max = backoff_max
+        self.errori = {t: 0 for t in self.schedule}
+        self.ultimo_errore = {}
+        self._prossimo = {t: 0.0 for t in self.schedule}
+        self._fermo = threading.Event()
+
+    def stop(self):
+        self._fermo.set()
+
+    def run(self):
+        while not self._fermo.is_set():
+            ora = time.monotonic()
+            for nome in sorted((t for t, p in self._prossimo.items() if p <= ora), key=self._prossimo.get):
+                if self._fermo.is_set(): return
+                try:
+                    self.store.refresh(nome)
+                    self.errori[nome] = 0
+                    self._prossimo[nome] = time.monotonic() + self.schedule[nome]
+                except CircuitoAperto:
+                    # Nessuna chiamata fatta: si riprova quando il circuito si richiude
+                    self._prossimo[nome] = max(self.store.breaker.aperto_fino, time.monotonic() + 1)
+                except Exception as e:
+                    self.errori[nome] += 1
+                    self.ultimo_errore[nome] = str(e)
+                    attesa = min(self.schedule[nome] * 2 ** self.errori[nome], self.backoff_max)
+                    self._prossimo[nome] = time.monotonic() + attesa
+            self._fermo.wait(max(0.5, min(self._prossimo.values(), default=60) - time.monotonic()))
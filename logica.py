@@ -0,0 +1,182 @@
+# =========================================================
+# LOGICA DI BUSINESS (SENZA STREAMLIT)
+# =========================================================
+# Regole usate sia dalla Dashboard sia dai job da riga di comando (cli.py):
+# ricevono i DataFrame delle tabelle e restituiscono DataFrame filtrati.
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+GIORNI_RECALL = 7
+GIORNI_REINSERIMENTO = 2
+GIORNI_PREVENTIVO = 7
+GIORNI_PREAVVISO_SCORTE = 7   # avviso se la soglia verrà raggiunta entro questi giorni
+GIORNI_CONSEGNA_MATERIALE = 7 # tempo medio tra ordine e arrivo del materiale
+
+
+def oggi_ts():
+    return pd.Timestamp.now().normalize()
+
+
+def _colonne(df, default):
+    for c, v in default.items():
+        if c not in df.columns: df[c] = v
+    return df
+
+
+def prepara_pazienti(df):
+    if df.empty: return df
+    df = df.copy()
+    for col in ['Disdetto', 'Visita_Esterna']:
+        if col not in df.columns: df[col] = False
+        df[col] = df[col].fillna(False)
+    for col in ['Data_Disdetta', 'Data_Visita']:
+        if col not in df.columns: df[col] = None
+        df[col] = pd.to_datetime(df[col], errors='coerce')
+    return _colonne(df, {'Area': None, 'Nome': "", 'Cognome': ""})
+
+
+def disdetti(df):
+    return df[(df['Disdetto'] == True) | (df['Disdetto'] == 1)]
+
+
+def attivi(df):
+    return df[(df['Disdetto'] == False) | (df['Disdetto'] == 0)]
+
+
+def da_richiamare(df, oggi=None):
+    # Disdetti da almeno GIORNI_RECALL giorni
+    oggi = oggi if oggi is not None else oggi_ts()
+    d = disdetti(df)
+    return d[(d['Data_Disdetta'].notna()) & (d['Data_Disdetta'] <= oggi - pd.Timedelta(days=GIORNI_RECALL))]
+
+
+def visite_esterne(df):
+    return df[(df['Visita_Esterna'] == True) | (df['Visita_Esterna'] == 1)]
+
+
+def visite_settimana(df, oggi=None):
+    oggi = oggi if oggi is not None else oggi_ts()
+    v = visite_esterne(df)
+    return v[v['Data_Visita'].apply(lambda x: x.isocalendar()[1] if pd.notnull(x) else -1) == oggi.isocalendar()[1]]
+
+
+def visite_da_reinserire(df, oggi=None):
+    oggi = oggi if oggi is not None else oggi_ts()
+    v = visite_esterne(df)
+    return v[(v['Data_Visita'].notna()) & (oggi >= (v['Data_Visita'] + pd.Timedelta(days=GIORNI_REINSERIMENTO)))]
+
+
+def prepara_prestiti(df):
+    if df.empty: return df
+    df = _colonne(df.copy(), {'Restituito': False, 'Data_Scadenza': None, 'Oggetto': "Strumento", 'Paziente': "Sconosciuto"})
+    df['Data_Scadenza'] = pd.to_datetime(df['Data_Scadenza'], errors='coerce')
+    return df
+
+
+def prestiti_scaduti(df, oggi=None):
+    if df.empty: return pd.DataFrame()
+    oggi = oggi if oggi is not None else oggi_ts()
+    return df[(df['Restituito'] != True) & (df['Data_Scadenza'] < oggi) & (df['Data_Scadenza'].notna())]
+
+
+def prepara_preventivi(df):
+    if df.empty: return df
+    df = _colonne(df.copy(), {'Data_Creazione': None, 'Paziente': "", 'Totale': 0})
+    df['Data_Creazione'] = pd.to_datetime(df['Data_Creazione'], errors='coerce')
+    return df
+
+
+def preventivi_scaduti(df, oggi=None):
+    # Preventivi senza risposta da più di GIORNI_PREVENTIVO giorni
+    if df.empty: return pd.DataFrame()
+    oggi = oggi if oggi is not None else oggi_ts()
+    return df[df['Data_Creazione'] <= oggi - timedelta(days=GIORNI_PREVENTIVO)]
+
+
+def prepara_inventario(df):
+    if df.empty: return df
+    if 'Quantità' in df.columns: df = df.rename(columns={'Quantità': 'Quantita'})
+    else: df = df.copy()
+    return _colonne(df, {'Quantita': 0, 'Soglia_Minima': 0, 'Materiali': 0})
+
+
+def scorte_basse(df):
+    if df.empty: return pd.DataFrame()
+    return df[df['Quantita'] <= df['Soglia_Minima']]
+
+
+# --- SCORTE: PREVISIONE DA CONSUMI ---
+def previsione_scorte(df, tassi, orizzonte=14):
+    # tassi: {id articolo: consumo/giorno} (movimenti.Consumi.tassi).
+    # Giorni_Soglia = giorni prima di arrivare alla soglia minima (0 se già
+    # sotto, NaN senza consumi registrati); Da_Ordinare riporta all'obiettivo
+    # coprendo anche i consumi durante la consegna.
+    if df.empty: return pd.DataFrame()
+    df = _colonne(df.copy(), {'Obiettivo': 0, 'Area': None})
+    for c in ['Quantita', 'Obiettivo', 'Soglia_Minima']:
+        df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
+    df['Consumo_Giorno'] = df['id'].map(tassi).fillna(0.0)
+    margine = (df['Quantita'] - df['Soglia_Minima']).clip(lower=0)
+    df['Giorni_Soglia'] = (margine / df['Consumo_Giorno'].where(df['Consumo_Giorno'] > 0)).round(1)
+    df.loc[df['Quantita'] <= df['Soglia_Minima'], 'Giorni_Soglia'] = 0.0
+    df['Da_Ordinare'] = np.ceil((df['Obiettivo'] - df['Quantita'] + df['Consumo_Giorno'] * GIORNI_CONSEGNA_MATERIALE).clip(lower=0)).astype(int)
+    df['Da_Riordinare'] = df['Giorni_Soglia'].notna() & (df['Giorni_Soglia'] <= orizzonte)
+    return df.sort_values('Giorni_Soglia', na_position='last', kind='stable')
+
+
+def scorte_in_esaurimento(df, tassi, giorni=GIORNI_PREAVVISO_SCORTE):
+    # Come scorte_basse, più gli articoli che ci arriveranno entro "giorni"
+    prev = previsione_scorte(df, tassi, giorni)
+    if prev.empty: return prev
+    return prev[prev['Da_Riordinare']]
+
+
+def riordini_per_stanza(df, tassi, orizzonte=14):
+    # {stanza: articoli da riordinare}, una lista d'ordine per stanza
+    # (per "Sede · stanza" quando i dati arrivano da più sedi)
+    prev = previsione_scorte(df, tassi, orizzonte)
+    if prev.empty: return {}
+    prev = prev[prev['Da_Riordinare'] & (prev['Da_Ordinare'] > 0)]
+    gruppo = prev['Area'].fillna("Senza stanza").astype(str)
+    if 'Sede' in prev.columns and prev['Sede'].nunique() > 1: gruppo = prev['Sede'].astype(str) + " · " + gruppo
+    return {nome: g for nome, g in prev.groupby(gruppo, sort=True)}
+
+
+def prepara_consegne(df):
+    if df.empty: return df
+    df = _colonne(df.copy(), {'Completato': False, 'Data_Scadenza': None, 'Paziente': None, 'Area': "Altro", 'Indicazione': ""})
+    df = df.dropna(subset=['Paziente'])
+    df['Data_Scadenza'] = pd.to_datetime(df['Data_Scadenza'], errors='coerce')
+    return df
+
+
+def consegne_pendenti(df):
+    if df.empty: return pd.DataFrame()
+    return df[df['Completato'] != True]
+
+
+# --- CONSEGNE: INDICE PRIORITÀ ---
+COLORI_STATO_CONSEGNA = {"scaduto": "border-red", "urgente": "border-yellow", "ok": "border-green", "nd": "border-gray"}
+
+
+def classifica_consegne(df_cons, oggi=None):
+    # Pendenti ordinati per scadenza, con Giorni e Stato calcolati in un passaggio
+    if df_cons.empty: return pd.DataFrame()
+    oggi = oggi if oggi is not None else oggi_ts()
+    df = _colonne(df_cons.copy(), {'Area': "Altro", 'Data_Scadenza': None, 'Completato': False, 'Paziente': "Sconosciuto", 'Indicazione': ""})
+    df = df[df['Completato'] != True]
+    df['Paziente'] = df['Paziente'].fillna("Sconosciuto")
+    df['Indicazione'] = df['Indicazione'].fillna("")
+    df['Data_Scadenza'] = pd.to_datetime(df['Data_Scadenza'], errors='coerce')
+    df['Giorni'] = (df['Data_Scadenza'] - oggi).dt.days
+    df['Stato'] = np.select([df['Giorni'].isna(), df['Giorni'] < 0, df['Giorni'] <= 3], ["nd", "scaduto", "urgente"], "ok")
+    return df.sort_values('Data_Scadenza', na_position='last', kind='stable')
+
+
+def indice_consegne(df_cons, oggi=None):
+    # {area: pendenti ordinati per scadenza}
+    df = classifica_consegne(df_cons, oggi)
+    if df.empty: return {}
+    return {area: g for area, g in df.groupby('Area', sort=False)}
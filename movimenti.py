@@ -0,0 +1,161 @@
+# =========================================================
+# MOVIMENTI DI MAGAZZINO (REGISTRO E CONSUMI)
+# =========================================================
+# Ogni variazione di Quantità diventa un evento append-only nella tabella
+# Movimenti (scritto a blocchi con batch_create). I consumi per articolo sono
+# tenuti in un SQLite locale come media esponenziale aggiornata evento per
+# evento: O(nuovi eventi), senza rileggere lo storico. La previsione dei
+# riordini vera e propria è in logica.previsione_scorte.
+#
+# Gli eventi passano prima da una tabella "in uscita" dello stesso SQLite:
+# un riavvio o un'interruzione di Airtable non li perde, vengono cancellati
+# solo dopo che batch_create è andato a buon fine.
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+from datastore import BATCH_AIRTABLE, DATA_DIR
+
+TABELLA = "Movimenti"
+TAU_GIORNI = 30.0      # "memoria" della media dei consumi
+MIN_GIORNI_STORICO = 7 # prima di questo storico nessun tasso (come senza eventi)
+MOTIVO_RETTIFICA = "Rettifica"  # correzione dopo un conteggio: sta nel registro, non è consumo
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS consumo (
+    articolo_id TEXT PRIMARY KEY,
+    s REAL NOT NULL,          -- consumi decaduti esponenzialmente
+    t_ultimo REAL NOT NULL,   -- giorno (epoch/86400) dell'ultimo evento
+    t_primo REAL NOT NULL     -- giorno del primo evento
+);
+CREATE TABLE IF NOT EXISTS elaborati (id TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS in_uscita (
+    n INTEGER PRIMARY KEY AUTOINCREMENT,
+    campi TEXT NOT NULL       -- fields del record Movimenti, in JSON
+);
+"""
+
+
+def percorso_db(base_id):
+    # Un database per base (sede): i consumi seguono il registro della propria base
+    return os.path.join(DATA_DIR, f"movimenti_{base_id}.sqlite")
+
+
+def _giorni(ts):
+    return pd.Timestamp(ts).timestamp() / 86400.0
+
+
+class Consumi:
+    # Tasso di consumo (unità/giorno) per articolo
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._conn() as conn: conn.executescript(SCHEMA)
+
+    @contextmanager
+    def _conn(self):
+        # Connessione per singola operazione: "with" di sqlite3 fa solo il
+        # commit, la chiusura va fatta a mano (il processo Streamlit vive a lungo)
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn: yield conn
+        finally:
+            conn.close()
+
+    def vuoto(self):
+        with self._conn() as conn:
+            return conn.execute("SELECT 1 FROM elaborati LIMIT 1").fetchone() is None
+
+    def applica(self, eventi):
+        # eventi: dict con id (Evento_ID), articolo_id, delta, data, motivo. Gli
+        # id già visti vengono ignorati; contano come consumo solo le uscite
+        # (delta < 0) che non sono rettifiche di inventario.
+        with self._conn() as conn:
+            for ev in sorted(eventi, key=lambda e: str(e['data'])):
+                if conn.execute("INSERT OR IGNORE INTO elaborati VALUES (?)", (ev['id'],)).rowcount == 0: continue
+                if ev['delta'] >= 0 or ev.get('motivo') == MOTIVO_RETTIFICA or not ev.get('articolo_id') or not ev.get('data'): continue
+                t, q = _giorni(ev['data']), -float(ev['delta'])
+                row = conn.execute("SELECT s, t_ultimo, t_primo FROM consumo WHERE articolo_id = ?", (ev['articolo_id'],)).fetchone()
+                if row is None:
+                    conn.execute("INSERT INTO consumo VALUES (?, ?, ?, ?)", (ev['articolo_id'], q, t, t))
+                else:
+                    s, t_ultimo, t_primo = row
+                    s = s * math.exp(-max(t - t_ultimo, 0) / TAU_GIORNI) + q
+                    conn.execute("UPDATE consumo SET s = ?, t_ultimo = ?, t_primo = ? WHERE articolo_id = ?",
+                                 (s, max(t, t_ultimo), min(t, t_primo), ev['articolo_id']))
+
+    def tassi(self, ora=None):
+        # Media esponenziale portata a "ora"; per articoli con poco storico si
+        # corregge il peso mancante (1 - e^(-età/tau)) per non sottostimare.
+        # Sotto MIN_GIORNI_STORICO l'articolo resta fuori: qualche uscita
+        # ravvicinata non diventa un consumo giornaliero da estrapolare.
+        t_ora = _giorni(ora or pd.Timestamp.now())
+        with self._conn() as conn:
+            righe = conn.execute("SELECT articolo_id, s, t_ultimo, t_primo FROM consumo").fetchall()
+        tassi = {}
+        for aid, s, t_ultimo, t_primo in righe:
+            if t_ora - t_primo < MIN_GIORNI_STORICO: continue
+            s_ora = s * math.exp(-max(t_ora - t_ultimo, 0) / TAU_GIORNI)
+            peso = 1 - math.exp(-(t_ora - t_primo) / TAU_GIORNI)
+            tassi[aid] = s_ora / (TAU_GIORNI * peso)
+        return tassi
+
+
+def evento_da_record(rec_id, f):
+    # Evento_ID è assegnato alla creazione: un eventuale doppio invio non conta due volte
+    return {'id': f.get('Evento_ID') or rec_id, 'articolo_id': f.get('Articolo_ID'), 'delta': int(f.get('Delta') or 0), 'data': f.get('Data'), 'motivo': f.get('Motivo')}
+
+
+class CodaMovimenti:
+    # Coda persistente svuotata a blocchi di 10 da un thread (ogni "intervallo"
+    # secondi, o subito quando il blocco è pieno). Se Airtable non risponde gli
+    # eventi restano su disco e si riprova al giro dopo (anche dopo un riavvio).
+    def __init__(self, store, consumi, intervallo=20):
+        self.store = store
+        self.consumi = consumi
+        self.intervallo = intervallo
+        self._lock = threading.Lock()
+        self._sveglia = threading.Event()
+        threading.Thread(target=self._ciclo, name="movimenti-flush", daemon=True).start()
+
+    def aggiungi(self, articolo_id, articolo, stanza, delta, quantita_dopo, motivo):
+        if not delta: return
+        campi = {
+            "Evento_ID": uuid.uuid4().hex, "Articolo_ID": articolo_id, "Articolo": articolo, "Stanza": stanza,
+            "Delta": int(delta), "Quantita_Dopo": int(quantita_dopo), "Motivo": motivo,
+            "Data": datetime.now().isoformat(timespec="seconds"),
+        }
+        with self.consumi._conn() as conn:
+            conn.execute("INSERT INTO in_uscita (campi) VALUES (?)", (json.dumps(campi, ensure_ascii=False),))
+        # I consumi si aggiornano subito, senza aspettare Airtable
+        self.consumi.applica([evento_da_record(None, campi)])
+        if self.in_coda() >= BATCH_AIRTABLE: self._sveglia.set()
+
+    def in_coda(self):
+        with self.consumi._conn() as conn:
+            return conn.execute("SELECT COUNT(*) FROM in_uscita").fetchone()[0]
+
+    def flush(self):
+        with self._lock:
+            while True:
+                with self.consumi._conn() as conn:
+                    righe = conn.execute("SELECT n, campi FROM in_uscita ORDER BY n LIMIT ?", (BATCH_AIRTABLE,)).fetchall()
+                if not righe: return
+                self.store.table(TABELLA).batch_create([json.loads(c) for _, c in righe], typecast=True)
+                with self.consumi._conn() as conn:
+                    conn.executemany("DELETE FROM in_uscita WHERE n = ?", [(n,) for n, _ in righe])
+
+    def _ciclo(self):
+        while True:
+            self._sveglia.wait(self.intervallo)
+            self._sveglia.clear()
+            try: self.flush()
+            except Exception: time.sleep(self.intervallo)
@@ -0,0 +1,78 @@
+# =========================================================
+# CALENDARIO PRESTITI E PRENOTAZIONI
+# =========================================================
+# Una prenotazione è un normale record di Prestiti con Data_Prestito futura.
+# Per ogni strumento gli intervalli aperti (non restituiti) sono tenuti ordinati
+# per inizio, con il massimo progressivo delle fine: conflitti e disponibilità
+# si trovano con una ricerca binaria invece di filtrare tutta la tabella.
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from datetime import date
+
+import pandas as pd
+
+Intervallo = namedtuple("Intervallo", "inizio fine id paziente")
+
+INIZIO_IGNOTO = date(2000, 1, 1)
+
+
+def _data(val):
+    if val is None: return None
+    ts = pd.to_datetime(val, errors='coerce')
+    return None if pd.isna(ts) else ts.date()
+
+
+class CalendarioPrestiti:
+    def __init__(self, records, oggi=None):
+        # records = {id: fields} della tabella Prestiti
+        self.oggi = oggi or date.today()
+        per_oggetto = {}
+        for rid, f in records.items():
+            if f.get('Restituito') == True or not f.get('Oggetto'): continue
+            inizio = _data(f.get('Data_Prestito')) or INIZIO_IGNOTO
+            fine = _data(f.get('Data_Scadenza')) or inizio
+            # Un prestito non ancora restituito occupa lo strumento almeno fino a oggi
+            if inizio <= self.oggi: fine = max(fine, self.oggi)
+            per_oggetto.setdefault(f['Oggetto'], []).append(Intervallo(inizio, max(fine, inizio), rid, f.get('Paziente', "")))
+        self._indice = {}
+        for oggetto, intervalli in per_oggetto.items():
+            intervalli.sort()
+            max_fine, acc = [], None
+            for iv in intervalli:
+                acc = iv.fine if acc is None else max(acc, iv.fine)
+                max_fine.append(acc)
+            self._indice[oggetto] = (intervalli, [iv.inizio for iv in intervalli], max_fine)
+
+    def conflitti(self, oggetto, inizio, fine):
+        # Intervalli di "oggetto" che si sovrappongono a [inizio, fine] (estremi inclusi)
+        if oggetto not in self._indice: return []
+        intervalli, inizi, max_fine = self._indice[oggetto]
+        da = bisect_left(max_fine, inizio)     # prima di qui tutto finisce prima di "inizio"
+        a = bisect_right(inizi, fine)          # da qui in poi tutto inizia dopo "fine"
+        return [iv for iv in intervalli[da:a] if iv.fine >= inizio]
+
+    def libero(self, oggetto, inizio, fine):
+        return not self.conflitti(oggetto, inizio, fine)
+
+    def disponibili(self, oggetti, inizio, fine):
+        return [o for o in oggetti if self.libero(o, inizio, fine)]
+
+    def in_corso(self, oggetto):
+        return self.conflitti(oggetto, self.oggi, self.oggi)
+
+    def prossima_prenotazione(self, oggetto):
+        if oggetto not in self._indice: return None
+        intervalli, inizi, _ = self._indice[oggetto]
+        i = bisect_right(inizi, self.oggi)
+        return intervalli[i] if i < len(intervalli) else None
+
+    def tabella(self, oggetti, inizio, fine):
+        # Una riga per intervallo nel periodo: Inizio/Fine tagliati sul periodo
+        # (per il grafico), Dal/Al con le date reali
+        righe = []
+        for o in oggetti:
+            for iv in self.conflitti(o, inizio, fine):
+                stato = "In prestito" if iv.inizio <= self.oggi else "Prenotato"
+                righe.append({'id': iv.id, 'Oggetto': o, 'Inizio': pd.Timestamp(max(iv.inizio, inizio)), 'Fine': pd.Timestamp(min(iv.fine, fine)) + pd.Timedelta(days=1),
+                              'Dal': iv.inizio, 'Al': iv.fine, 'Paziente': iv.paziente, 'Stato': stato})
+        return pd.DataFrame(righe, columns=['id', 'Oggetto', 'Inizio', 'Fine', 'Dal', 'Al', 'Paziente', 'Stato'])
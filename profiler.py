@@ -0,0 +1,167 @@
+# =========================================================
+# PROFILER DEI RERUN (OPZIONALE)
+# =========================================================
+# Attivo solo con ?profile=1 nell'URL, FISIO_PROFILING=1 o PROFILING = true
+# nei secrets. Per ogni rerun misura il tempo di ogni tratto dello script,
+# conta widget ed elementi inviati al browser e la dimensione dei messaggi;
+# per i rerun più lenti salva il file cProfile (.prof) da aprire con
+# snakeviz o flameprof per il flamegraph.
+#
+# Dal Python 3.12 cProfile usa sys.monitoring, globale al processo: un secondo
+# Profile().enable() fallisce. Il registro concede quindi cProfile a un solo
+# rerun alla volta; gli altri misurano solo tempi e messaggi.
+#
+# Il conteggio dei messaggi aggancia ScriptRunContext._enqueue, API interna di
+# Streamlit (requirements.txt fissa le versioni provate). Se manca o cambia
+# forma il profilo ripiega sui soli tempi e lo dice ("messaggi" = False),
+# invece di riportare zero widget.
+import cProfile
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from datastore import DATA_DIR
+
+PROFILI_DIR = os.path.join(DATA_DIR, "profili")
+
+# Tipi di elemento (ForwardMsg.delta.new_element) che sono widget interattivi
+WIDGET = {
+    "button", "download_button", "checkbox", "color_picker", "date_input", "file_uploader",
+    "multiselect", "number_input", "radio", "selectbox", "slider", "text_area", "text_input",
+    "time_input", "camera_input", "chat_input", "button_group", "arrow_data_frame",
+}
+
+
+class ProfiloRerun:
+    def __init__(self, ctx=None, cprofile=True, registro=None):
+        self.inizio = time.perf_counter()
+        self.avvio = datetime.now()
+        self.tratti = []                 # [(nome, secondi)]
+        self._ultimo = self.inizio
+        self.widget = 0
+        self.elementi = 0
+        self.blocchi = 0
+        self.byte = 0
+        self.per_tipo = {}
+        self.ultimo_messaggio = self.inizio
+        self.interrotto = False
+        self.durata = None
+        self.file_prof = None
+        self._ctx = ctx
+        self._enqueue_orig = None
+        self.messaggi = False            # True se i messaggi verso il browser vengono contati
+        self._registro = registro
+        self.thread = threading.current_thread()
+        self._cprofile = cProfile.Profile() if cprofile else None
+        self._aggancia()
+        if self._cprofile is not None:
+            try: self._cprofile.enable()
+            except ValueError: self._cprofile = None  # altro profiler attivo (debugger, coverage...)
+
+    def _aggancia(self):
+        # Intercetta i messaggi verso il browser (API interna di Streamlit: se
+        # cambia, restano comunque tempi e cProfile)
+        ctx = self._ctx
+        orig = getattr(ctx, "_enqueue", None)
+        if not callable(orig): return
+
+        def enqueue(msg):
+            if self.messaggi:
+                try: self._conta(msg)
+                except Exception: self.messaggi = False  # messaggi di forma nuova: solo tempi
+            return orig(msg)
+        try: ctx._enqueue = enqueue
+        except (AttributeError, TypeError): return
+        self._enqueue_orig = orig
+        self.messaggi = True
+
+    def _conta(self, msg):
+        self.ultimo_messaggio = time.perf_counter()
+        self.byte += msg.ByteSize()
+        if msg.WhichOneof("type") != "delta": return
+        tipo = msg.delta.WhichOneof("type")
+        if tipo == "add_block": self.blocchi += 1
+        elif tipo == "new_element":
+            el = msg.delta.new_element.WhichOneof("type")
+            self.elementi += 1
+            self.per_tipo[el] = self.per_tipo.get(el, 0) + 1
+            if el in WIDGET: self.widget += 1
+
+    def segna(self, nome):
+        # Chiude il tratto corrente dello script con il nome indicato
+        ora = time.perf_counter()
+        self.tratti.append((nome, ora - self._ultimo))
+        self._ultimo = ora
+
+    def chiudi(self, interrotto=False):
+        if self.durata is not None: return
+        try:
+            if self._cprofile is not None: self._cprofile.disable()
+        finally:
+            if self._ctx is not None and self._enqueue_orig is not None:
+                self._ctx._enqueue = self._enqueue_orig
+            if self._registro is not None: self._registro._rilascia(self)
+        # Se lo script è stato interrotto (st.rerun / st.stop) la fine reale è
+        # l'ultimo messaggio inviato, non il momento in cui ce ne accorgiamo
+        fine = self.ultimo_messaggio if interrotto else time.perf_counter()
+        if interrotto: self.tratti.append(("(interrotto)", max(0.0, fine - self._ultimo)))
+        self.interrotto = interrotto
+        self.durata = fine - self.inizio
+
+    def riepilogo(self):
+        return {
+            "ora": self.avvio.strftime('%H:%M:%S'),
+            "sezione": self.tratti[-1][0] if self.tratti else "",
+            "ms": round(self.durata * 1000),
+            "widget": self.widget, "elementi": self.elementi, "blocchi": self.blocchi,
+            "KB": round(self.byte / 1024, 1),
+            "messaggi": self.messaggi,
+            "cProfile": self._cprofile is not None,
+            "tratti": ", ".join(f"{n} {s * 1000:.0f}ms" for n, s in self.tratti),
+            "prof": os.path.basename(self.file_prof) if self.file_prof else "",
+        }
+
+
+class RegistroProfili:
+    # Storico condiviso del processo + i file .prof dei "peggiori" rerun
+    def __init__(self, max_storico=200, max_file=10, cartella=PROFILI_DIR):
+        self.storico = deque(maxlen=max_storico)
+        self.max_file = max_file
+        self.cartella = cartella
+        self._peggiori = []              # [(durata, path)]
+        self._lock = threading.RLock()
+        self._attivo = None              # unico profilo con cProfile acceso
+
+    def avvia(self, ctx=None):
+        with self._lock:
+            vecchio = self._attivo
+            if vecchio is not None and not vecchio.thread.is_alive():
+                # Rerun interrotto (st.stop) il cui thread è già finito: si
+                # libera subito il posto invece di aspettare la sua sessione
+                vecchio.chiudi(interrotto=True)
+                self.registra(vecchio)
+            profilo = ProfiloRerun(ctx, cprofile=self._attivo is None, registro=self)
+            if profilo._cprofile is not None: self._attivo = profilo
+            return profilo
+
+    def _rilascia(self, profilo):
+        with self._lock:
+            if self._attivo is profilo: self._attivo = None
+
+    def registra(self, profilo):
+        with self._lock:
+            if profilo._cprofile is not None and (len(self._peggiori) < self.max_file or profilo.durata > self._peggiori[0][0]):
+                os.makedirs(self.cartella, exist_ok=True)
+                sezione = "".join(c for c in (profilo.tratti[-1][0] if profilo.tratti else "") if c.isalnum()) or "app"
+                path = os.path.join(self.cartella, f"{profilo.avvio:%Y%m%d_%H%M%S}_{sezione}_{round(profilo.durata * 1000)}ms.prof")
+                profilo._cprofile.dump_stats(path)
+                profilo.file_prof = path
+                self._peggiori.append((profilo.durata, path))
+                self._peggiori.sort()
+                if len(self._peggiori) > self.max_file:
+                    _, vecchio = self._peggiori.pop(0)
+                    try: os.remove(vecchio)
+                    except OSError: pass
+            self.storico.append(profilo.riepilogo())
@@ -0,0 +1,126 @@
+# =========================================================
+# ROLLUP GIORNALIERI (STORICO AREE E RETENTION)
+# =========================================================
+# Ogni giorno viene salvata una riga di aggregati in un piccolo SQLite locale:
+# i grafici storici leggono poche centinaia di righe invece di riscansionare
+# le tabelle Airtable. Si scrive solo il giorno corrente (riscritto finché non
+# finisce): i giorni chiusi restano congelati.
+import os
+import sqlite3
+
+import pandas as pd
+
+from datastore import DATA_DIR
+
+DB_PATH = os.path.join(DATA_DIR, "rollup.sqlite")
+
+# Nessun recupero dei giorni passati: lo stato dei pazienti (Disdetto, Area)
+# non ha storico, quindi un giorno in cui né l'app né il job notturno
+# (cli.py rollup) sono girati resta un buco nel grafico invece di un numero
+# inventato a partire dai flag di oggi.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup_area (
+    giorno TEXT NOT NULL, area TEXT NOT NULL,
+    attivi INTEGER NOT NULL, disdetti INTEGER NOT NULL,
+    PRIMARY KEY (giorno, area)
+);
+CREATE TABLE IF NOT EXISTS rollup_giorno (
+    giorno TEXT PRIMARY KEY,
+    attivi INTEGER NOT NULL, disdetti INTEGER NOT NULL, recall INTEGER NOT NULL,
+    prestiti_fuori INTEGER NOT NULL, preventivi_creati INTEGER NOT NULL
+);
+"""
+
+
+def connetti(path=DB_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def _col(df, nome, default):
+    return df[nome] if nome in df.columns else pd.Series(default, index=df.index)
+
+
+def _flag(serie):
+    return serie.fillna(False).isin([True, 1])
+
+
+def _aree(serie):
+    # Area può arrivare come lista (multiselect) o come "A, B": come nel
+    # grafico della Dashboard, un paziente conta in tutte le sue aree
+    def split(x):
+        if isinstance(x, list): return [str(a).strip() for a in x if str(a).strip()]
+        if isinstance(x, str): return [a.strip() for a in x.split(',') if a.strip()]
+        return []
+    return serie.map(split)
+
+
+def _aggregati(paz, pres, prev, giorno):
+    # Stato attuale dei record, con le date che decidono recall e prestiti fuori
+    disdetto = paz['disdetto'] & (paz['data_disdetta'].isna() | (paz['data_disdetta'] <= giorno))
+    recall = disdetto & (paz['data_disdetta'] <= giorno - pd.Timedelta(days=7))
+    per_area = (pd.DataFrame({'area': paz['aree'], 'disdetti': disdetto.astype(int), 'attivi': (~disdetto).astype(int)})
+                .explode('area').dropna(subset=['area']).groupby('area').sum())
+    fuori = int(((pres['data_prestito'] <= giorno) & ~pres['restituito']).sum()) if not pres.empty else 0
+    creati = int((prev['data_creazione'] == giorno).sum()) if not prev.empty else 0
+    totale = {'attivi': int((~disdetto).sum()), 'disdetti': int(disdetto.sum()), 'recall': int(recall.sum()),
+              'prestiti_fuori': fuori, 'preventivi_creati': creati}
+    return per_area, totale
+
+
+def aggiorna(df_paz, df_pres, df_prev, oggi=None, conn=None):
+    # Riscrive la riga di oggi; ritorna quanti giorni ha scritto (0 o 1)
+    oggi = (pd.Timestamp.now() if oggi is None else pd.Timestamp(oggi)).normalize()
+    if df_paz.empty: return 0
+    chiudi = conn is None
+    conn = conn or connetti()
+    try:
+        paz = pd.DataFrame({
+            'aree': _aree(_col(df_paz, 'Area', None)),
+            'disdetto': _flag(_col(df_paz, 'Disdetto', False)),
+            'data_disdetta': pd.to_datetime(_col(df_paz, 'Data_Disdetta', None), errors='coerce'),
+        })
+        pres = pd.DataFrame({
+            'data_prestito': pd.to_datetime(_col(df_pres, 'Data_Prestito', None), errors='coerce'),
+            'restituito': _flag(_col(df_pres, 'Restituito', False)),
+        }) if not df_pres.empty else pd.DataFrame()
+        prev = pd.DataFrame({
+            'data_creazione': pd.to_datetime(_col(df_prev, 'Data_Creazione', None), errors='coerce').dt.normalize(),
+        }) if not df_prev.empty else pd.DataFrame()
+
+        per_area, totale = _aggregati(paz, pres, prev, oggi)
+        g = oggi.strftime('%Y-%m-%d')
+        with conn:
+            conn.execute("DELETE FROM rollup_area WHERE giorno = ?", (g,))
+            conn.executemany("INSERT OR REPLACE INTO rollup_area VALUES (?, ?, ?, ?)",
+                             [(g, area, int(r.attivi), int(r.disdetti)) for area, r in per_area.iterrows()])
+            conn.execute("INSERT OR REPLACE INTO rollup_giorno VALUES (?, ?, ?, ?, ?, ?)",
+                         (g, totale['attivi'], totale['disdetti'], totale['recall'], totale['prestiti_fuori'], totale['preventivi_creati']))
+        return 1
+    finally:
+        if chiudi: conn.close()
+
+
+def leggi_aree(da=None, conn=None):
+    chiudi = conn is None
+    conn = conn or connetti()
+    try:
+        df = pd.read_sql_query("SELECT * FROM rollup_area WHERE giorno >= ? ORDER BY giorno", conn, params=(str(da or "0000-00-00")[:10],))
+    finally:
+        if chiudi: conn.close()
+    df['giorno'] = pd.to_datetime(df['giorno'])
+    return df
+
+
+def leggi_giorni(da=None, conn=None):
+    chiudi = conn is None
+    conn = conn or connetti()
+    try:
+        df = pd.read_sql_query("SELECT * FROM rollup_giorno WHERE giorno >= ? ORDER BY giorno", conn, params=(str(da or "0000-00-00")[:10],))
+    finally:
+        if chiudi: conn.close()
+    df['giorno'] = pd.to_datetime(df['giorno'])
+    return df
@@ -0,0 +1,85 @@
+# =========================================================
+# PIÙ SEDI (UNA BASE AIRTABLE PER SEDE)
+# =========================================================
+# Ogni sede ha il suo TableStore (rate limit, circuit breaker, refresher e
+# snapshot propri). StoreSedi espone le stesse letture di TableStore sulle
+# sedi scelte: le tabelle vengono lette in parallelo e, con più sedi, unite
+# con la colonna "Sede"; le scritture vanno allo store che possiede il record.
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+COLONNA_SEDE = "Sede"
+
+
+class StoreSedi:
+    def __init__(self, stores, predefinita=None):
+        # stores: {nome sede: TableStore}; predefinita = sede dei record nuovi
+        self.stores = dict(stores)
+        self.predefinita = predefinita if predefinita in self.stores else next(iter(self.stores))
+        self._pool = ThreadPoolExecutor(max_workers=max(len(self.stores), 1), thread_name_prefix="sedi")
+        self._lock = threading.Lock()
+        self._uniti = {}   # nome tabella -> (versioni, DataFrame unito)
+
+    @property
+    def multipla(self):
+        return len(self.stores) > 1
+
+    def store_di(self, rid=None):
+        # Store che contiene il record (gli id Airtable sono unici fra le basi);
+        # senza id o record non ancora letto: la sede predefinita
+        if rid:
+            for s in self.stores.values():
+                if s.contiene(rid): return s
+        return self.stores[self.predefinita]
+
+    def sede_di(self, rid):
+        s = self.store_di(rid)
+        return next(n for n, x in self.stores.items() if x is s)
+
+    def get(self, nome, max_age=None):
+        # Download in parallelo: il tempo è quello della sede più lenta, non la somma
+        futuri = {sede: self._pool.submit(s.get, nome, max_age) for sede, s in self.stores.items()}
+        parti = {sede: f.result() for sede, f in futuri.items()}
+        # Una sola sede: il DataFrame di TableStore (già una copia), senza colonna Sede
+        if not self.multipla: return next(iter(parti.values()))
+        versioni = self.version(nome)
+        with self._lock:
+            vecchio = self._uniti.get(nome)
+            if vecchio is not None and vecchio[0] == versioni: return vecchio[1].copy()
+        df = pd.concat([p.assign(**{COLONNA_SEDE: sede}) for sede, p in parti.items() if not p.empty], ignore_index=True) \
+            if any(not p.empty for p in parti.values()) else pd.DataFrame()
+        with self._lock: self._uniti[nome] = (versioni, df)
+        return df.copy()
+
+    def assicura(self, nome, max_age=None):
+        for f in [self._pool.submit(s.assicura, nome, max_age) for s in self.stores.values()]: f.result()
+
+    def record(self, nome, rid):
+        for s in self.stores.values():
+            rec = s.record(nome, rid)
+            if rec is not None: return rec
+        return None
+
+    def records(self, nome):
+        unione = {}
+        for s in self.stores.values(): unione.update(s.records(nome))
+        return unione
+
+    def refresh(self, nome):
+        for f in [self._pool.submit(s.refresh, nome) for s in self.stores.values()]: f.result()
+
+    def age(self, nome):
+        eta = [a for a in (s.age(nome) for s in self.stores.values()) if a is not None]
+        return max(eta) if eta else None
+
+    def stato(self, nome):
+        # Dato più vecchio fra le sedi; "vecchio" se almeno una sede non risponde
+        stati = [s.stato(nome) for s in self.stores.values()]
+        ts = [t for t, _ in stati if t is not None]
+        return (min(ts) if ts else None), any(v for _, v in stati)
+
+    def version(self, nome):
+        # Tupla (base, versione): chiave di cache diversa per ogni combinazione di sedi
+        return tuple((s.base_id, s.version(nome)) for s in self.stores.values())